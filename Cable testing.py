@@ -1,5 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from moteus_fdcan_adapter import QueryPlan
 import time
 
 def main():
@@ -12,6 +13,8 @@ def main():
     ###################################################################################################################
 
     c = Controller(controller_ID=1) #create controller object
+    measured = QueryPlan([(MoteusReg.MOTEUS_REG_VELOCITY, MoteusReg.F32),
+                          (MoteusReg.MOTEUS_REG_TEMP_C, MoteusReg.INT8)]) #only velocity and temperature are used below
     c.command_stop() #comand_stop cleares anny errors/faults in the controller
     max_measured_velocity = 0 #this variable stores the max measured rotational velocity of the motor and is used for safety and can be observed as an erformance indicator
     counter = 0 #if you had to interrupt testing and need to start again but not count from 0 - input the number starting number you want here.
@@ -24,16 +27,16 @@ def main():
         if phase < pull_duration:
             #initiall full torque pull
             measurements = c.set_position(position = 0, max_torque=4, ff_torque=max_torque, kp_scale=0, kd_scale=0,
-                                          get_data=True, print_data=False) #measurements are collected to extract velocity - which if too high stops the system (safety)
+                                          get_data=True, print_data=False, query_plan=measured) #measurements are collected to extract velocity - which if too high stops the system (safety)
         elif phase >= pull_duration and phase <= pull_duration+release_duration:
             #gradual release
             release_phase = ((pull_duration+release_duration-phase)/release_duration) #value normalized from 1 to 0.
             torque = standbay_torque+(max_torque-standbay_torque)*release_phase #torque ges from max_torque to standby_torque
             measurements = c.set_position(position = 0, max_torque=4, ff_torque=torque, kp_scale=0, kd_scale=0,
-                                          get_data=True, print_data=False) #measurements are collected to extract velocity - which if too high stops the system (safety)
+                                          get_data=True, print_data=False, query_plan=measured) #measurements are collected to extract velocity - which if too high stops the system (safety)
         else:
             measurements = c.set_position(position = 0, max_torque=4, ff_torque=standbay_torque , kp_scale=0,
-                                          kd_scale=0.1, get_data=True, print_data=False) #measurements are collected to extract velocity - which if too high stops the system (safety)
+                                          kd_scale=0.1, get_data=True, print_data=False, query_plan=measured) #measurements are collected to extract velocity - which if too high stops the system (safety)
 
         if max_measured_velocity < abs(measurements[MoteusReg.MOTEUS_REG_VELOCITY]): #for diagnostics
             max_measured_velocity = abs(measurements[MoteusReg.MOTEUS_REG_VELOCITY])
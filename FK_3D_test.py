@@ -1,6 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
-import time
+from rate_loop import RateLoop
 import math
 from kinematics_3D import Kinematics
 
@@ -14,8 +14,8 @@ def main():
 
     freq=20
 
+    loop = RateLoop(freq)
     while True:
-        freq_measure_time = time.time()
 
         response_data_knee = controller_knee.get_data()
         robot_knee_rot_org = response_data_knee[MoteusReg.MOTEUS_REG_POSITION]
@@ -53,10 +53,8 @@ def main():
 
 
 
-        sleep = (1 / freq) - (time.time() - freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
-        # print(f'freq: {1 / (time.time() - freq_measure_time):.1f}')
+        loop.wait()
+        # print(loop.summary())
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
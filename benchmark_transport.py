@@ -0,0 +1,204 @@
+"""Throughput and latency benchmark for moteus_fdcan_adapter.
+
+Runs against the fdcanusb simulator on a pty by default, or any bus
+open_bus accepts with --device (an fdcanusb, socketcan:<interface> or
+the in-process sim), so transports can be compared.  Measures:
+
+  encode      time to build a set_position(get_data=True) command
+  decode      time to parse a standard get_data reply payload
+  ok          adapter "OK" latency, from the end of the write (fdcanusb
+              without a reader only)
+  rcv         device reply latency, from the end of the write
+  rate        sustained cycles/s for 1..N controllers in fire-and-forget,
+              query (one round trip per controller) and pipelined
+              (bus.cycle) modes
+
+Results can be saved as a baseline and later runs compared against it:
+
+    python benchmark_transport.py --save baseline.json
+    python benchmark_transport.py --baseline baseline.json
+"""
+import argparse
+import json
+import time
+
+from fdcanusb_simulator import FdcanusbSimulator
+from moteus_fdcan_adapter import FdcanusbBus
+from moteus_fdcan_adapter import open_bus
+from moteus_fdcan_adapter import percentile
+
+PERCENTILES = (50, 90, 99, 99.9)
+# The tails are too noisy on a desktop to gate on.
+COMPARED_PERCENTILES = ('p50', 'p90')
+MODES = ('fire_and_forget', 'query', 'pipelined')
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    result = {}
+    for point in PERCENTILES:
+        result['p{}'.format(point)] = percentile(ordered, point)
+    result['max'] = ordered[-1]
+    return result
+
+
+def histogram(samples, bins=20, width=50):
+    low = min(samples)
+    high = max(samples)
+    step = (high - low) / bins or 1e-9
+    counts = [0] * bins
+    for sample in samples:
+        counts[min(bins - 1, int((sample - low) / step))] += 1
+    peak = max(counts)
+    lines = []
+    for i, count in enumerate(counts):
+        lines.append('{:9.1f}us |{:<{width}}| {}'.format(
+            (low + i * step) * 1e6, '#' * int(round(count / peak * width)), count, width=width))
+    return '\n'.join(lines)
+
+
+def time_calls(function, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_encode(controller, count):
+    return time_calls(lambda: controller.make_position(0.1, get_data=True), count)
+
+
+def bench_decode(bus, controller, count):
+    command = controller.make_query()
+    payload, = bus.receive_batch([command], bus.send_batch([command]))
+    return time_calls(lambda: command.parse(payload), count)
+
+
+def bench_round_trip(bus, controller, count):
+    timings = bus.enable_timings(count)
+    for _ in range(count):
+        bus.cycle([controller.make_position(0.1, get_data=True)])
+    bus.disable_timings()
+    return timings.intervals('written', 'ok'), timings.intervals('written', 'rcv')
+
+
+def bench_rate(bus, controllers, mode, duration):
+    cycles = 0
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        if mode == 'fire_and_forget':
+            bus.cycle([controller.make_position(0.1) for controller in controllers])
+        elif mode == 'query':
+            for controller in controllers:
+                controller.set_position(0.1, get_data=True)
+        else:
+            bus.cycle([controller.make_position(0.1, get_data=True) for controller in controllers])
+        cycles += 1
+    return cycles / (time.perf_counter() - start)
+
+
+def run(bus, controllers, samples, duration):
+    results = {}
+    first = controllers[0]
+    results['encode'] = percentiles(bench_encode(first, samples))
+    results['decode'] = percentiles(bench_decode(bus, first, samples))
+    ok_samples, rcv_samples = bench_round_trip(bus, first, samples)
+    if ok_samples:
+        results['ok'] = percentiles(ok_samples)
+    results['rcv'] = percentiles(rcv_samples)
+    rates = {}
+    for mode in MODES:
+        for count in range(1, len(controllers) + 1):
+            rates['{}/{}'.format(mode, count)] = bench_rate(bus, controllers[:count], mode, duration)
+    results['rate'] = rates
+    return results, rcv_samples
+
+
+def report(results, baseline=None, tolerance=0.2):
+    regressions = []
+    print('{:8s} '.format('latency') + ' '.join('{:>10s}'.format(key) for key in results['encode']))
+    for name in ('encode', 'decode', 'ok', 'rcv'):
+        if name not in results:
+            continue
+        row = '{:8s} '.format(name)
+        for key, value in results[name].items():
+            row += '{:>8.1f}us'.format(value * 1e6)
+            if baseline is not None and key in COMPARED_PERCENTILES and key in baseline.get(name, {}):
+                if value > baseline[name][key] * (1 + tolerance):
+                    row += '!'
+                    regressions.append('{} {}: {:.1f}us -> {:.1f}us'.format(
+                        name, key, baseline[name][key] * 1e6, value * 1e6))
+                else:
+                    row += ' '
+            else:
+                row += ' '
+        print(row)
+    print()
+    print('{:20s} {:>10s}'.format('rate', 'cycles/s') + ('  {:>10s}'.format('baseline') if baseline else ''))
+    for key, value in results['rate'].items():
+        row = '{:20s} {:>10.0f}'.format(key, value)
+        if baseline is not None and key in baseline.get('rate', {}):
+            previous = baseline['rate'][key]
+            row += '  {:>10.0f}'.format(previous)
+            if value < previous * (1 - tolerance):
+                row += '  !'
+                regressions.append('rate {}: {:.0f}/s -> {:.0f}/s'.format(key, previous, value))
+        print(row)
+    if regressions:
+        print()
+        print('regressions beyond {:.0f}%:'.format(tolerance * 100))
+        for regression in regressions:
+            print('  ' + regression)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--device', type=str, default=None,
+                        help='bus to benchmark instead of the pty simulator: '
+                             'fdcanusb device, socketcan:<interface> or sim')
+    parser.add_argument('--ids', type=int, nargs='+', default=list(range(1, 13)), help='controller IDs')
+    parser.add_argument('--samples', type=int, default=2000, help='samples per latency measurement')
+    parser.add_argument('--duration', type=float, default=0.5, help='seconds per rate measurement')
+    parser.add_argument('--reply-latency', type=float, default=0., help='simulated device latency [s]')
+    parser.add_argument('--histogram', action='store_true', help='print the rcv latency histogram')
+    parser.add_argument('--save', type=str, default=None, help='write the results as a baseline')
+    parser.add_argument('--baseline', type=str, default=None, help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    simulator = None
+    device = args.device
+    if device is None:
+        simulator = FdcanusbSimulator(args.ids, reply_latency=args.reply_latency)
+        device = simulator.start()
+
+    bus = FdcanusbBus(device) if simulator is not None else open_bus(device)
+    try:
+        controllers = [bus.controller(controller_ID) for controller_ID in args.ids]
+        results, rcv_samples = run(bus, controllers, args.samples, args.duration)
+    finally:
+        bus.close()
+        if simulator is not None:
+            simulator.stop()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+    if args.histogram:
+        print()
+        print(histogram(rcv_samples))
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
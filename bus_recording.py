@@ -0,0 +1,229 @@
+"""Record bus traffic to a compact binary log and replay it later.
+
+RecordingBus wraps any transport and appends every outgoing command
+and every reply (or missed reply) to a memory-mapped log file.  A
+ReplayBus reads such a log and answers the same script's commands with
+the recorded replies, so a run can be repeated offline, without the
+robot and without waiting for the bus:
+
+    python example_jump_3D.py -d /dev/fdcanusb --record jump.log
+    python example_jump_3D.py -d replay:jump.log
+    python bus_recording.py jump.log
+
+The log is an 8 byte magic followed by records of a RECORD header
+(monotonic time in ns since the recording started, kind, controller ID,
+payload length) and the raw payload.
+"""
+import argparse
+import mmap
+import struct
+import time
+
+from moteus_fdcan_adapter import CanBus
+
+MAGIC = b'MFDLOG1\0'
+RECORD = struct.Struct('<QBBB')
+
+# Record kinds.  Zero is the unwritten tail of the file.
+COMMAND = 1
+QUERY = 2
+REPLY = 3
+MISSING = 4
+KIND_NAMES = {COMMAND: 'command', QUERY: 'query', REPLY: 'reply', MISSING: 'missing'}
+
+
+class LogWriter:
+    """Append-only record writer on a growing memory-mapped file."""
+
+    # The file is extended by this many bytes whenever it fills up.
+    CHUNK = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.size = self.CHUNK
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.map[:len(MAGIC)] = MAGIC
+        self.offset = len(MAGIC)
+        self.start = time.monotonic_ns()
+
+    def __grow(self):
+        self.map.close()
+        self.size += self.CHUNK
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def write(self, kind, controller_ID, payload=b''):
+        end = self.offset + RECORD.size + len(payload)
+        if end > self.size:
+            self.__grow()
+        RECORD.pack_into(self.map, self.offset, time.monotonic_ns() - self.start,
+                         kind, controller_ID, len(payload))
+        self.map[self.offset + RECORD.size:end] = payload
+        self.offset = end
+
+    def close(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        self.map.close()
+        self.map = None
+        # Drop the unwritten tail.
+        self.file.truncate(self.offset)
+        self.file.close()
+
+
+def read_log(path):
+    """Returns the records of a log as (time_ns, kind, controller_ID, payload) tuples."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise RuntimeError('{} is not a bus log'.format(path))
+    records = []
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        stamp, kind, controller_ID, size = RECORD.unpack_from(data, offset)
+        if kind == 0:
+            break
+        offset += RECORD.size
+        records.append((stamp, kind, controller_ID, data[offset:offset + size]))
+        offset += size
+    return records
+
+
+class RecordingBus(CanBus):
+    """Runs commands through another transport and logs all of the traffic."""
+    _shared = {}
+
+    def __init__(self, transport, path):
+        super().__init__(transport.timeout)
+        self.transport = transport
+        self.log = LogWriter(path)
+        self.misses = transport.misses
+
+    @classmethod
+    def shared(cls, transport, path):
+        bus = cls._shared.get(path)
+        if bus is None:
+            bus = cls(transport, path)
+            cls._shared[path] = bus
+        else:
+            bus.timeout = transport.timeout
+        return bus
+
+    def close(self):
+        self.log.close()
+        self.transport.close()
+        if RecordingBus._shared.get(self.log.path) is self:
+            del RecordingBus._shared[self.log.path]
+
+    def _missed(self, target):
+        # The wrapped transport is the one that sees late replies.
+        self.transport._missed(target)
+
+    def __record_replies(self, commands, payloads):
+        log = self.log
+        for command, payload in zip(commands, payloads):
+            if command.reply:
+                if payload is None:
+                    log.write(MISSING, command.target)
+                else:
+                    log.write(REPLY, command.target, payload)
+        return payloads
+
+    def send_batch(self, commands):
+        log = self.log
+        for command in commands:
+            log.write(QUERY if command.reply else COMMAND, command.target, command.frame)
+        return self.transport.send_batch(commands)
+
+    def receive_batch(self, commands, receipt, deadline=None):
+        return self.__record_replies(commands, self.transport.receive_batch(commands, receipt, deadline))
+
+    async def async_receive_batch(self, commands, receipt, deadline=None):
+        return self.__record_replies(
+            commands, await self.transport.async_receive_batch(commands, receipt, deadline))
+
+
+class ReplayBus(CanBus):
+    """Answers commands with the replies from a recorded log.
+
+    Replies are handed back in recorded order without any waiting.
+    Commands are compared to the recorded ones: differences are counted
+    in mismatches, or raise RuntimeError with strict=True.
+    """
+    _shared = {}
+
+    def __init__(self, path, strict=False, timeout=None):
+        super().__init__(timeout)
+        self.path = path
+        self.strict = strict
+        self.records = read_log(path)
+        self.position = 0
+        self.mismatches = 0
+
+    @classmethod
+    def shared(cls, path, timeout=None):
+        bus = cls._shared.get(path)
+        if bus is None:
+            bus = cls(path, timeout=timeout)
+            cls._shared[path] = bus
+        elif timeout is not None:
+            bus.timeout = timeout
+        return bus
+
+    def close(self):
+        if ReplayBus._shared.get(self.path) is self:
+            del ReplayBus._shared[self.path]
+
+    def __next(self):
+        if self.position >= len(self.records):
+            raise RuntimeError('replay of {} ran out of records'.format(self.path))
+        record = self.records[self.position]
+        self.position += 1
+        return record
+
+    def __mismatch(self, message):
+        if self.strict:
+            raise RuntimeError('replay of {} diverged at record {}: {}'.format(
+                self.path, self.position - 1, message))
+        self.mismatches += 1
+
+    def send_batch(self, commands):
+        for command in commands:
+            _, kind, controller_ID, frame = self.__next()
+            if kind not in (COMMAND, QUERY):
+                raise RuntimeError('replay of {} expected a command at record {}, found a {}'.format(
+                    self.path, self.position - 1, KIND_NAMES.get(kind, kind)))
+            if controller_ID != command.target or (kind == QUERY) != bool(command.reply):
+                self.__mismatch('sent to {}, recorded for {}'.format(command.target, controller_ID))
+            elif frame != command.frame:
+                self.__mismatch('frame {} differs from {}'.format(command.frame.hex(), frame.hex()))
+
+    def receive_batch(self, commands, receipt, deadline=None):
+        payloads = []
+        for command in commands:
+            payload = None
+            if command.reply:
+                _, kind, controller_ID, data = self.__next()
+                if kind not in (REPLY, MISSING):
+                    raise RuntimeError('replay of {} expected a reply at record {}, found a {}'.format(
+                        self.path, self.position - 1, KIND_NAMES.get(kind, kind)))
+                if kind == REPLY:
+                    payload = data
+            payloads.append(payload)
+        return payloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', type=str, help='bus log to print')
+    args = parser.parse_args()
+
+    for stamp, kind, controller_ID, payload in read_log(args.log):
+        print('{:12.6f} {:7s} {:3d} {}'.format(stamp * 1e-9, KIND_NAMES[kind], controller_ID, payload.hex()))
+
+
+if __name__ == '__main__':
+    main()
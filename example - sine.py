@@ -1,13 +1,14 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
 import time
 import math
 
 def main():
     controller_1 = Controller(controller_ID = 1)
     freq=300
+    loop = RateLoop(freq)
     while True:
-        freq_measure_time = time.time()
 
 
         phase = (time.time()*1) % (2. * math.pi)
@@ -20,9 +21,7 @@ def main():
 
         # controller_1.set_torque(torque=torque_Nm)
 
-        sleep = (1/(freq))-(time.time()-freq_measure_time)
-        if(sleep<0): sleep = 0
-        time.sleep(sleep)
+        loop.wait()
 
 
 if __name__ == '__main__':
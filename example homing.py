@@ -1,5 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
 import time
 import math
 from kinematics_3D import Kinematics
@@ -25,8 +26,8 @@ def main():
 
 
 
+    loop = RateLoop(freq)
     while 1:
-        freq_measure_time = time.time()
 
         if (robot_hip_torque < 0.4):
 
@@ -42,9 +43,7 @@ def main():
             print("hip:", hip_home_offset)
             break
 
-        sleep = (1 / freq) - (time.time() - freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
+        loop.wait()
 
     while 1:
         freq_measure_time = time.time()
@@ -85,17 +84,15 @@ def main():
             print("abad:", abad_home_offset)
             break
 
+    loop = RateLoop(freq)
     while 1:
-        freq_measure_time = time.time()
 
         controller_hip.set_position(position=hip_home_offset - 1.3, max_torque=0.3, kd_scale=1)
         controller_knee.set_position(position=knee_home_offset +0.19, max_torque=0.3, kd_scale=0.7)
         controller_abad.set_position(position=abad_home_offset + 1.4, max_torque=0.3, kd_scale=0.7)
 
 
-        sleep = (1 / freq) - (time.time() - freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
+        loop.wait()
 
 
 
@@ -1,5 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
 import time
 import math
 from kinematics import Kinematics
@@ -16,8 +17,8 @@ def main():
 
     freq=300
 
+    loop = RateLoop(freq)
     while True:
-        freq_measure_time = time.time()
         phase = (time.time() * 16) % (2*math.pi)
 
         z = 190+50*math.sin(phase)
@@ -59,10 +60,8 @@ def main():
 
 
 
-        sleep = (1/freq)-(time.time()-freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
-        #print(f'freq: {1 / (time.time() - freq_measure_time):.1f}')
+        loop.wait()
+        #print(loop.summary())
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
+from loop_profiler import LoopProfiler
 import time
 import math
 from kinematics_3D import Kinematics
@@ -13,6 +15,7 @@ def main():
     controller_knee = Controller(controller_ID = 1)
     controller_hip = Controller(controller_ID = 2)
     controller_abad = Controller(controller_ID=3)
+    bus = controller_knee.bus
     kinematics = Kinematics()
     freq = 300
 
@@ -49,7 +52,10 @@ def main():
 
 
 
+    loop = RateLoop(freq)
+    profiler = LoopProfiler(('trajectory', 'ik'))
     while True:
+        profiler.tick()
 
         stride = 130#math.sin(((time.time() * 0.5) % (2 * math.pi)))*50+50
         print(stride)
@@ -84,7 +90,6 @@ def main():
 
 
 
-        freq_measure_time = time.time()
         phase = (time.time()-begin_time+lift_duration+ground_duration) % period
 
         if phase <= ground_end:
@@ -96,12 +101,16 @@ def main():
             z=ground_z+(ground_z-ground_z)*ground_phase
 
 
+            profiler.mark('trajectory')
             if kinematics.if_ik_possible(x,y, z):
                 knee, hip, abad = kinematics.ik(x, y, z)
+                profiler.mark('ik')
 
-                controller_knee.set_position(position=knee, max_torque=torque, kd_scale=kd_scale_ground, kp_scale=kp_scale_ground)
-                controller_hip.set_position(position=hip, max_torque=torque, kd_scale=kd_scale_ground, kp_scale=kp_scale_ground)
-                controller_abad.set_position(position=abad, max_torque=torque, kd_scale=kd_scale_ground, kp_scale=kp_scale_ground)
+                profiler.cycle(bus, [
+                    controller_knee.make_position(position=knee, max_torque=torque, kd_scale=kd_scale_ground, kp_scale=kp_scale_ground),
+                    controller_hip.make_position(position=hip, max_torque=torque, kd_scale=kd_scale_ground, kp_scale=kp_scale_ground),
+                    controller_abad.make_position(position=abad, max_torque=torque, kd_scale=kd_scale_ground, kp_scale=kp_scale_ground),
+                ])
             else:
                 print(x,z)
 
@@ -113,12 +122,16 @@ def main():
             z = ground_z + (air_z - ground_z) * (math.sin(lift_phase * math.pi - math.pi / 2) / 2 + 0.5)
 
 
+            profiler.mark('trajectory')
             if kinematics.if_ik_possible(x,y, z):
                 knee, hip, abad = kinematics.ik(x, y, z)
+                profiler.mark('ik')
 
-                controller_knee.set_position(position=knee, max_torque=torque, kd_scale=kd_scale_ground-(kd_scale_ground-kd_scale_air)*lift_phase, kp_scale=kp_scale_ground-(kp_scale_ground-kp_scale_air)*lift_phase)
-                controller_hip.set_position(position=hip, max_torque=torque, kd_scale=kd_scale_ground-(kd_scale_ground-kd_scale_air)*lift_phase, kp_scale=kp_scale_ground-(kp_scale_ground-kp_scale_air)*lift_phase)
-                controller_abad.set_position(position=abad, max_torque=torque, kd_scale=kd_scale_ground-(kd_scale_ground-kd_scale_air)*lift_phase, kp_scale=kp_scale_ground-(kp_scale_ground-kp_scale_air)*lift_phase)
+                profiler.cycle(bus, [
+                    controller_knee.make_position(position=knee, max_torque=torque, kd_scale=kd_scale_ground-(kd_scale_ground-kd_scale_air)*lift_phase, kp_scale=kp_scale_ground-(kp_scale_ground-kp_scale_air)*lift_phase),
+                    controller_hip.make_position(position=hip, max_torque=torque, kd_scale=kd_scale_ground-(kd_scale_ground-kd_scale_air)*lift_phase, kp_scale=kp_scale_ground-(kp_scale_ground-kp_scale_air)*lift_phase),
+                    controller_abad.make_position(position=abad, max_torque=torque, kd_scale=kd_scale_ground-(kd_scale_ground-kd_scale_air)*lift_phase, kp_scale=kp_scale_ground-(kp_scale_ground-kp_scale_air)*lift_phase),
+                ])
             else:
                 print(x,z)
                 
@@ -130,12 +143,16 @@ def main():
             z = air_z
 
 
+            profiler.mark('trajectory')
             if kinematics.if_ik_possible(x,y, z):
                 knee, hip, abad = kinematics.ik(x, y, z)
+                profiler.mark('ik')
 
-                controller_knee.set_position(position=knee, max_torque=torque, kd_scale=kd_scale_air, kp_scale=kp_scale_air)
-                controller_hip.set_position(position=hip, max_torque=torque, kd_scale=kd_scale_air, kp_scale=kp_scale_air)
-                controller_abad.set_position(position=abad, max_torque=torque, kd_scale=kd_scale_air, kp_scale=kp_scale_air)
+                profiler.cycle(bus, [
+                    controller_knee.make_position(position=knee, max_torque=torque, kd_scale=kd_scale_air, kp_scale=kp_scale_air),
+                    controller_hip.make_position(position=hip, max_torque=torque, kd_scale=kd_scale_air, kp_scale=kp_scale_air),
+                    controller_abad.make_position(position=abad, max_torque=torque, kd_scale=kd_scale_air, kp_scale=kp_scale_air),
+                ])
             else:
                 print(x,z)
 
@@ -148,19 +165,21 @@ def main():
             y = y_zero + math.sin(direction)* (start_x + (sin_scaler *(ground_z - air_z)) * (math.sin(descend_phase*math.pi)))
             z = air_z + (ground_z - air_z) * (math.sin(descend_phase*math.pi-math.pi/2)/2+0.5)
 
+            profiler.mark('trajectory')
             if kinematics.if_ik_possible(x,y, z):
                 knee, hip, abad = kinematics.ik(x, y, z)
+                profiler.mark('ik')
 
-                controller_knee.set_position(position=knee, max_torque=torque, kd_scale=kd_scale_air+(kd_scale_ground-kd_scale_air)*descend_phase, kp_scale=kp_scale_air+(kp_scale_ground-kp_scale_air)*descend_phase)
-                controller_hip.set_position(position=hip, max_torque=torque, kd_scale=kd_scale_air+(kd_scale_ground-kd_scale_air)*descend_phase, kp_scale=kp_scale_air+(kp_scale_ground-kp_scale_air)*descend_phase)
-                controller_abad.set_position(position=abad, max_torque=torque, kd_scale=kd_scale_air+(kd_scale_ground-kd_scale_air)*descend_phase, kp_scale=kp_scale_air+(kp_scale_ground-kp_scale_air)*descend_phase)
+                profiler.cycle(bus, [
+                    controller_knee.make_position(position=knee, max_torque=torque, kd_scale=kd_scale_air+(kd_scale_ground-kd_scale_air)*descend_phase, kp_scale=kp_scale_air+(kp_scale_ground-kp_scale_air)*descend_phase),
+                    controller_hip.make_position(position=hip, max_torque=torque, kd_scale=kd_scale_air+(kd_scale_ground-kd_scale_air)*descend_phase, kp_scale=kp_scale_air+(kp_scale_ground-kp_scale_air)*descend_phase),
+                    controller_abad.make_position(position=abad, max_torque=torque, kd_scale=kd_scale_air+(kd_scale_ground-kd_scale_air)*descend_phase, kp_scale=kp_scale_air+(kp_scale_ground-kp_scale_air)*descend_phase),
+                ])
             else:
                 print(x,z)
 
-        sleep = (1/freq)-(time.time()-freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
-        #print(f'freq: {1 / (time.time() - freq_measure_time):.1f}')
+        loop.wait()
+        #print(loop.summary())
 
 
 if __name__ == '__main__':
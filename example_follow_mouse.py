@@ -1,6 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
-import time
+from rate_loop import RateLoop
 import math
 import pyautogui
 from kinematics_3D import Kinematics
@@ -22,8 +22,8 @@ def main():
     freq = 200
 
 
+    loop = RateLoop(freq)
     while True:
-        freq_measure_time = time.time()
 
         x_in, y_in = pyautogui.position()
 
@@ -49,9 +49,7 @@ def main():
         controller_hip.set_position(position=hip, max_torque=1, kd_scale=0.4, kp_scale=0.8)
         controller_abad.set_position(position=abad, max_torque=1, kd_scale=0.4, kp_scale=0.8)
 
-        sleep = (1 / freq) - (time.time() - freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
+        loop.wait()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
 import time
 import math
 from kinematics import Kinematics
@@ -35,8 +36,8 @@ def main():
     begin_time=time.time()
 
 
+    loop = RateLoop(freq)
     while True:
-        freq_measure_time = time.time()
         phase = (time.time()-begin_time+idle_duration+jump_duration) % (period)
 
         if phase <= jump_duration:
@@ -108,10 +109,8 @@ def main():
 
 
 
-        sleep = (1/freq)-(time.time()-freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
-        #print(f'freq: {1 / (time.time() - freq_measure_time):.1f}')
+        loop.wait()
+        #print(loop.summary())
 
 
 if __name__ == '__main__':
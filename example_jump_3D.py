@@ -1,5 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
 import time
 import math
 from kinematics_3D import Kinematics
@@ -48,6 +49,7 @@ def main():
         time.sleep(0.01)
 
 
+    loop = RateLoop(freq)
     while True:
         while True:
             y_rand = 58 #50*math.cos(time.time()/0.8) +48#random.randrange(58-30, 58+30)
@@ -68,7 +70,6 @@ def main():
         #print('NEW')
         while phase<(period-1/freq):
             #print(phase)
-            freq_measure_time = time.time()
             phase = (time.time()-begin_time) % (period)
 
             if phase <= jump_duration:
@@ -114,10 +115,8 @@ def main():
 
 
 
-            sleep = (1/freq)-(time.time()-freq_measure_time)
-            if sleep < 0: sleep = 0
-            time.sleep(sleep)
-            #print(f'freq: {1 / (time.time() - freq_measure_time):.1f}')
+            loop.wait()
+            #print(loop.summary())
         x_rand_prev = x_rand
         y_rand_prev = y_rand
 
@@ -1,5 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
 import time
 import math
 from kinematics_3D import Kinematics
@@ -17,8 +18,8 @@ def main():
 
     freq=200
 
+    loop = RateLoop(freq)
     while True:
-        freq_measure_time = time.time()
         phase1 = (time.time()*10) % (2*math.pi)
         phase2 = (time.time()*0.5) % (2 * math.pi)
 
@@ -39,10 +40,8 @@ def main():
 
 
 
-        sleep = (1/freq)-(time.time()-freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
-        #print(f'freq: {1 / (time.time() - freq_measure_time):.1f}')
+        loop.wait()
+        #print(loop.summary())
 
 
 if __name__ == '__main__':
@@ -1,8 +1,8 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
+from rate_loop import RateLoop
 import numpy as np
 from scipy.signal import butter, filtfilt
-import time
 
 
 def main():
@@ -28,6 +28,7 @@ def main():
     response_data_c1 = controller_1.get_data()
     response_data_c2 = controller_2.get_data()
 
+    loop = RateLoop(freq)
     while True:
 
 
@@ -43,7 +44,6 @@ def main():
         # controller_1.set_position(position=(pos_deg_c2)/ 360, velocity=vel_dps_c2/360,  max_torque=0.5, kd_scale=0.2, kp_scale=1)
         # controller_2.set_position(position=(-pos_deg_c1-110) / 360, velocity=-vel_dps_c1/360, max_torque=0.5, kd_scale=0.2, kp_scale=1)
 
-        freq_measure_time = time.time()
 
 
 
@@ -64,11 +64,7 @@ def main():
 
 
 
-        print(f'pos c1: {pos_deg_c1:.1f} pos c2: {pos_deg_c2:.1f}')
-
-        sleep = (1/(freq))-(time.time()-freq_measure_time)
-        if(sleep<0): sleep = 0
-        time.sleep(sleep)
+        loop.wait()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
 from moteus_fdcan_adapter import Controller
 from moteus_fdcan_adapter import MoteusReg
-import time
+from rate_loop import RateLoop
 import math
 from kinematics_3D import Kinematics
 
@@ -21,9 +21,9 @@ def main():
     velocity_abad = 0
 
     tq=0
+    loop = RateLoop(freq)
     while True:
 
-        freq_measure_time = time.time()
 
         x = 0
         y = 0
@@ -66,10 +66,8 @@ def main():
 
 
 
-        sleep = (1/freq)-(time.time()-freq_measure_time)
-        if sleep < 0: sleep = 0
-        time.sleep(sleep)
-        #print(f'freq: {1 / (time.time() - freq_measure_time):.1f}')
+        loop.wait()
+        #print(loop.summary())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,440 @@
+"""Stand-in for an fdcanusb with moteus controllers attached.
+
+Creates a pseudo-terminal that speaks the fdcanusb text protocol
+("can send" in, "OK" and "rcv" out) and answers register reads and
+writes from a set of simulated controllers, so anything built on
+moteus_fdcan_adapter can run without hardware:
+
+    python fdcanusb_simulator.py --ids 1 2 3 --link /tmp/fdcanusb
+    python example_Trot.py -d /tmp/fdcanusb
+
+With --socketcan the same controllers answer binary frames on a
+SocketCAN interface instead, usually a vcan, for SocketcanBus.
+
+SimulatorBus skips the transport altogether and runs the controllers
+in-process, it is what "-d sim" selects.
+"""
+import argparse
+import math
+import os
+import select
+import socket
+import threading
+import time
+import tty
+
+from moteus_fdcan_adapter import CAN_EFF_MASK
+from moteus_fdcan_adapter import CanBus
+from moteus_fdcan_adapter import MoteusMode
+from moteus_fdcan_adapter import MoteusReg
+from moteus_fdcan_adapter import block_opcode
+from moteus_fdcan_adapter import from_int
+from moteus_fdcan_adapter import pad_frame
+from moteus_fdcan_adapter import scale_of
+from moteus_fdcan_adapter import SocketcanBus
+from moteus_fdcan_adapter import to_int
+
+
+def _read_varuint(data, offset):
+    result = 0
+    shift = 0
+    for i in range(5):
+        this_byte = data[offset]
+        offset += 1
+        result |= (this_byte & 0x7f) << shift
+        shift += 7
+        if (this_byte & 0x80) == 0:
+            return result, offset
+    raise ValueError('varuint too long')
+
+
+class MotorModel:
+    """Rigid load on a motor: inertia in kg*m^2, viscous damping in
+    Nm/(rev/s), kp in Nm/rev and kd in Nm/(rev/s) at kp_scale/kd_scale 1,
+    and the torque limit used when max_torque is not given."""
+
+    def __init__(self, inertia=0.002, damping=0.01, kp=4.0, kd=0.2, torque_constant=0.1,
+                 max_torque=4.0, voltage=24.0, temperature=30.0):
+        self.inertia = inertia
+        self.damping = damping
+        self.kp = kp
+        self.kd = kd
+        self.torque_constant = torque_constant
+        self.max_torque = max_torque
+        self.voltage = voltage
+        self.temperature = temperature
+
+
+class SimulatedMoteus:
+    """Register file and position mode dynamics of one controller.
+
+    Like the firmware, a frame that writes registers starts from the
+    DEFAULT_COMMAND, position mode registers it leaves out don't keep
+    their values from earlier frames.
+    """
+
+    # Integration step, longer gaps between frames are sub-stepped.
+    STEP_S = 0.0005
+
+    DEFAULT_COMMAND = {
+        MoteusReg.MOTEUS_REG_POS_POSITION: math.nan,
+        MoteusReg.MOTEUS_REG_POS_VELOCITY: 0.,
+        MoteusReg.MOTEUS_REG_POS_TORQUE: 0.,
+        MoteusReg.MOTEUS_REG_POS_KP: 1.,
+        MoteusReg.MOTEUS_REG_POS_KD: 1.,
+        MoteusReg.MOTEUS_REG_MAX_TORQUE: math.nan,
+    }
+
+    def __init__(self, controller_ID, model=None):
+        self.controller_ID = controller_ID
+        self.model = model if model is not None else MotorModel()
+        self.mode = MoteusMode.STOPPED
+        self.position = 0.
+        self.velocity = 0.
+        self.torque = 0.
+        self.fault = 0
+        self.command = dict(self.DEFAULT_COMMAND)
+        self.last_step = time.monotonic()
+
+    def __command_torque(self):
+        if self.mode != MoteusMode.POSITION:
+            return 0.
+        command = self.command
+        model = self.model
+        torque = command[MoteusReg.MOTEUS_REG_POS_TORQUE]
+        position = command[MoteusReg.MOTEUS_REG_POS_POSITION]
+        if not math.isnan(position):
+            torque += model.kp * command[MoteusReg.MOTEUS_REG_POS_KP] * (position - self.position)
+        torque += model.kd * command[MoteusReg.MOTEUS_REG_POS_KD] * (
+            command[MoteusReg.MOTEUS_REG_POS_VELOCITY] - self.velocity)
+        limit = command[MoteusReg.MOTEUS_REG_MAX_TORQUE]
+        if math.isnan(limit) or limit > model.max_torque:
+            limit = model.max_torque
+        return max(-limit, min(limit, torque))
+
+    def step(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.last_step
+        self.last_step = now
+        model = self.model
+        while elapsed > 0:
+            dt = min(elapsed, self.STEP_S)
+            elapsed -= dt
+            self.torque = self.__command_torque()
+            # Work in rev and rev/s, the inertia is in SI units.
+            acceleration = (self.torque - model.damping * self.velocity) / model.inertia / (2 * math.pi)
+            self.velocity += acceleration * dt
+            self.position += self.velocity * dt
+
+    def read(self, register):
+        if register == MoteusReg.MOTEUS_REG_MODE:
+            return int(self.mode)
+        if register == MoteusReg.MOTEUS_REG_POSITION:
+            return self.position
+        if register == MoteusReg.MOTEUS_REG_VELOCITY:
+            return self.velocity
+        if register == MoteusReg.MOTEUS_REG_TORQUE:
+            return self.torque
+        if register == MoteusReg.MOTEUS_REG_Q_A:
+            return self.torque / self.model.torque_constant
+        if register == MoteusReg.MOTEUS_REG_D_A:
+            return 0.
+        if register == MoteusReg.MOTEUS_REG_V:
+            return self.model.voltage
+        if register == MoteusReg.MOTEUS_REG_TEMP_C:
+            return self.model.temperature
+        if register == MoteusReg.MOTEUS_REG_FAULT:
+            return self.fault
+        return self.command.get(register, 0)
+
+    def write(self, register, value):
+        if register == MoteusReg.MOTEUS_REG_MODE:
+            self.mode = MoteusMode(int(value))
+        elif register in self.command:
+            self.command[register] = value
+
+    def handle_frame(self, data):
+        """Applies a register frame, returns the reply payload (bytes)."""
+        self.step()
+        reply = bytearray()
+        offset = 0
+        written = False
+        while offset < len(data):
+            opcode, offset = _read_varuint(data, offset)
+            base = opcode & ~0x0f
+            if base == MoteusReg.NOP:
+                continue
+            if base not in (MoteusReg.WRITE_BASE, MoteusReg.READ_BASE):
+                break
+            field_type = (opcode & 0x0c) >> 2
+            count = opcode & 0x03
+            if count == 0:
+                count, offset = _read_varuint(data, offset)
+            start_reg, offset = _read_varuint(data, offset)
+            type_struct = MoteusReg._TYPE_STRUCTS[field_type]
+            if base == MoteusReg.WRITE_BASE:
+                if not written:
+                    self.command = dict(self.DEFAULT_COMMAND)
+                    written = True
+                for register in range(start_reg, start_reg + count):
+                    value, = type_struct.unpack_from(data, offset)
+                    offset += type_struct.size
+                    scale = scale_of(register, field_type)
+                    if scale is not None:
+                        value = from_int(value, scale, field_type)
+                    self.write(register, value)
+            else:
+                reply += block_opcode(MoteusReg.REPLY_BASE, field_type, start_reg, count)
+                for register in range(start_reg, start_reg + count):
+                    value = self.read(register)
+                    scale = scale_of(register, field_type)
+                    if scale is not None:
+                        value = to_int(float(value), scale, field_type)
+                    reply += type_struct.pack(value)
+        return pad_frame(bytes(reply))
+
+
+def answer(controllers, arbitration_id, data):
+    """Hands a frame to the addressed controller.
+
+    Returns (reply arbitration ID, payload) when a reply was asked for,
+    else None.
+    """
+    controller = controllers.get(arbitration_id & 0x7f)
+    if controller is None:
+        return None
+    reply = controller.handle_frame(data)
+    if not arbitration_id & 0x8000 or not reply:
+        return None
+    return (controller.controller_ID << 8) | ((arbitration_id >> 8) & 0x7f), reply
+
+
+class FdcanusbSimulator:
+    """Serves the fdcanusb text protocol for a set of SimulatedMoteus.
+
+    adapter_latency is waited before each "OK", reply_latency before
+    each "rcv", both in seconds.
+    """
+
+    def __init__(self, controller_IDs=(1,), model=None, adapter_latency=0., reply_latency=0.):
+        self.controllers = {controller_ID: SimulatedMoteus(controller_ID, model)
+                            for controller_ID in controller_IDs}
+        self.adapter_latency = adapter_latency
+        self.reply_latency = reply_latency
+        self.frames = 0
+        self.master = None
+        self._slave = None
+        self.path = None
+        self.link = None
+        self._thread = None
+        self._running = False
+
+    def handle_line(self, line):
+        """Returns the adapter's response lines (bytes) to one input line."""
+        fields = line.split()
+        if len(fields) < 3 or fields[0] != b'can' or fields[1] != b'send':
+            return [b'ERR unknown command']
+        arbitration_id = int(fields[2], 16)
+        data = bytes.fromhex(fields[3].decode('latin1')) if len(fields) > 3 else b''
+        self.frames += 1
+        if self.adapter_latency:
+            time.sleep(self.adapter_latency)
+        result = [b'OK']
+        reply = answer(self.controllers, arbitration_id, data)
+        if reply is not None:
+            if self.reply_latency:
+                time.sleep(self.reply_latency)
+            result.append('rcv {:x} {} E B F'.format(reply[0], reply[1].hex().upper()).encode('latin1'))
+        return result
+
+    def open(self, link=None):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        # Keep the slave open so the pty survives clients reconnecting.
+        self._slave = slave
+        if link is not None:
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+            self.link = link
+        return link if link is not None else self.path
+
+    def serve_forever(self):
+        pending = bytearray()
+        self._running = True
+        while self._running:
+            readable, _, _ = select.select([self.master], [], [], 0.05)
+            if not readable:
+                continue
+            pending += os.read(self.master, 4096)
+            while True:
+                end = pending.find(b'\n')
+                if end < 0:
+                    break
+                line = bytes(pending[:end]).strip()
+                del pending[:end + 1]
+                if not line:
+                    continue
+                response = self.handle_line(line)
+                os.write(self.master, b''.join([item + b'\r\n' for item in response]))
+
+    def start(self, link=None):
+        """Opens the pty and serves it from a daemon thread, returns its path."""
+        path = self.open(link)
+        self._thread = threading.Thread(target=self.serve_forever, name='fdcanusb-simulator', daemon=True)
+        self._thread.start()
+        return path
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.link is not None and os.path.islink(self.link):
+            os.unlink(self.link)
+        if self.master is not None:
+            os.close(self.master)
+            os.close(self._slave)
+            self.master = None
+
+
+class SocketcanSimulator:
+    """Answers moteus frames on a SocketCAN interface, normally a vcan."""
+
+    def __init__(self, controller_IDs=(1,), model=None, reply_latency=0.):
+        self.controllers = {controller_ID: SimulatedMoteus(controller_ID, model)
+                            for controller_ID in controller_IDs}
+        self.reply_latency = reply_latency
+        self.frames = 0
+        self.socket = None
+        self.interface = None
+        self._thread = None
+        self._running = False
+
+    def handle_packet(self, packet):
+        """Returns the reply canfd_frame (bytes) to one received frame, or None."""
+        can_id, size = SocketcanBus.HEADER.unpack_from(packet)
+        data = packet[SocketcanBus.DATA_OFFSET:SocketcanBus.DATA_OFFSET + size]
+        self.frames += 1
+        reply = answer(self.controllers, can_id & CAN_EFF_MASK, data)
+        if reply is None:
+            return None
+        if self.reply_latency:
+            time.sleep(self.reply_latency)
+        arbitration_id, payload = reply
+        # Answer with the ID format and flags of the request.
+        return SocketcanBus.FRAME.pack(arbitration_id | (can_id & ~CAN_EFF_MASK), len(payload), packet[5], payload)
+
+    def open(self, interface='vcan0'):
+        self.socket = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        self.socket.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FD_FRAMES, 1)
+        self.socket.bind((interface,))
+        self.interface = interface
+        return interface
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            readable, _, _ = select.select([self.socket], [], [], 0.05)
+            if not readable:
+                continue
+            reply = self.handle_packet(self.socket.recv(SocketcanBus.FRAME.size))
+            if reply is not None:
+                self.socket.send(reply)
+
+    def start(self, interface='vcan0'):
+        """Binds the interface and serves it from a daemon thread."""
+        self.open(interface)
+        self._thread = threading.Thread(target=self.serve_forever, name='socketcan-simulator', daemon=True)
+        self._thread.start()
+        return interface
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class SimulatorBus(CanBus):
+    """Transport that hands frames straight to SimulatedMoteus instances.
+
+    There is no pty, serial port or thread involved, a cycle costs just
+    the encoding, the simulation step and the decoding.  Controllers are
+    created on first use unless controller_IDs is given.
+    """
+    _instance = None
+
+    def __init__(self, controller_IDs=None, model=None, timeout=None):
+        super().__init__(timeout)
+        self.model = model
+        self.create = controller_IDs is None
+        self.controllers = {controller_ID: SimulatedMoteus(controller_ID, model)
+                            for controller_ID in controller_IDs or ()}
+        self.frames = 0
+
+    @classmethod
+    def shared(cls, timeout=None):
+        if cls._instance is None:
+            cls._instance = cls(timeout=timeout)
+        elif timeout is not None:
+            cls._instance.timeout = timeout
+        return cls._instance
+
+    def close(self):
+        if SimulatorBus._instance is self:
+            SimulatorBus._instance = None
+
+    def send_batch(self, commands):
+        for command in commands:
+            target = command.target
+            if self.create and target not in self.controllers:
+                self.controllers[target] = SimulatedMoteus(target, self.model)
+            self.frames += 1
+            reply = answer(self.controllers, (0x8000 if command.reply else 0) | target, command.frame)
+            if reply is not None:
+                self._accept((reply[0] >> 8) & 0x7f, reply[1])
+
+    def receive_batch(self, commands, receipt, deadline=None):
+        return [self.replies.pop(command.target, None) if command.reply else None
+                for command in commands]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ids', type=int, nargs='+', default=[1, 2, 3], help='simulated controller IDs')
+    parser.add_argument('--link', type=str, default='/tmp/fdcanusb', help='symlink created to the pty')
+    parser.add_argument('--socketcan', type=str, default=None,
+                        help='answer on this SocketCAN interface instead of a pty')
+    parser.add_argument('--inertia', type=float, default=0.002, help='load inertia [kg*m^2]')
+    parser.add_argument('--damping', type=float, default=0.01, help='viscous damping [Nm/(rev/s)]')
+    parser.add_argument('--kp', type=float, default=4.0, help='position gain at kp_scale 1 [Nm/rev]')
+    parser.add_argument('--kd', type=float, default=0.2, help='velocity gain at kd_scale 1 [Nm/(rev/s)]')
+    parser.add_argument('--adapter-latency', type=float, default=0., help='delay before OK [s]')
+    parser.add_argument('--reply-latency', type=float, default=0., help='delay before rcv [s]')
+    args = parser.parse_args()
+
+    model = MotorModel(inertia=args.inertia, damping=args.damping, kp=args.kp, kd=args.kd)
+    if args.socketcan is not None:
+        simulator = SocketcanSimulator(args.ids, model, reply_latency=args.reply_latency)
+        path = simulator.open(args.socketcan)
+    else:
+        simulator = FdcanusbSimulator(args.ids, model, adapter_latency=args.adapter_latency,
+                                      reply_latency=args.reply_latency)
+        path = simulator.open(args.link)
+    print('simulating controllers {} on {}'.format(args.ids, path))
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 homin_hip = 0.3688
 homing_knee = 0.478
 homing_abad= -1.6408
@@ -76,6 +78,22 @@ class Kinematics:
 
         return x, y, z
 
+    def fk_batch(self, joints):
+        """fk for an (N,3) array of knee, hip, abad positions, returns an (N,3) array of x, y, z."""
+        joints = np.asarray(joints, dtype=float)
+        knee_rad = self.robot_to_rad_for_knee(joints[:, 0])
+        hip_rad = self.robot_to_rad_for_hip(joints[:, 1])
+        abad_rad = self.robot_to_rad_for_abad(joints[:, 2])
+
+        leg = np.sin(knee_rad) * self.t + np.sin(hip_rad) * self.f
+        cos_abad = np.cos(abad_rad)
+        sin_abad = np.sin(abad_rad)
+        points = np.empty_like(joints)
+        points[:, 0] = np.cos(knee_rad) * self.t + np.cos(hip_rad) * self.f
+        points[:, 1] = self.abadY*cos_abad - self.abadZ*sin_abad - leg*sin_abad
+        points[:, 2] = self.abadZ*cos_abad + self.abadY*sin_abad + leg*cos_abad
+        return points
+
     def if_ik_possible(self, x, y, z): #TODO add y
         abad_rad=0
 
@@ -126,6 +144,40 @@ class Kinematics:
             print('inverse kinematics limits error')
             return math.nan, math.nan, math.nan
 
+    def ik_batch(self, points):
+        """ik for an (N,3) array of x, y, z.
+
+        Returns an (N,3) array of knee, hip, abad positions and a boolean
+        mask of the points that were reachable and within the limits,
+        the others are NaN.
+        """
+        points = np.asarray(points, dtype=float)
+        x = np.where(points[:, 0] == 0, 0.0000001, points[:, 0])
+        y = np.where(points[:, 1] == 0, 0.0000001, points[:, 1])
+        z = points[:, 2]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            zp = np.sqrt(y**2+z**2-self.abadY**2)-self.abadZ
+            abad_rad = -self.deg_to_rad(90) + (np.arctan2(z, y)+np.arctan2(self.abadY, zp+self.abadZ))
+
+            l = np.sqrt(x**2+zp**2)
+            delta = np.arccos((self.f ** 2 + l ** 2 - self.t ** 2) / (2 * self.f * l))
+            gamma = np.arctan2(zp, x)
+            gamma = np.where(gamma < 0, self.deg_to_rad(180) + gamma, gamma)
+
+            hip_rad = delta + gamma
+            denominator = x-self.f*np.cos(hip_rad)
+            knee_rad = np.arctan((zp-self.f*np.sin(hip_rad))/denominator)
+            knee_rad = np.where(knee_rad < 0, self.deg_to_rad(180) + knee_rad, knee_rad)
+
+            valid = (denominator != 0) & self.limits_batch(
+                self.rad_to_deg(knee_rad), self.rad_to_deg(hip_rad), self.rad_to_deg(abad_rad))
+
+        joints = np.full_like(points, math.nan)
+        joints[valid, 0] = self.rad_to_robot_for_knee(knee_rad[valid])
+        joints[valid, 1] = self.rad_to_robot_for_hip(hip_rad[valid])
+        joints[valid, 2] = self.rad_to_robot_for_abad(abad_rad[valid])
+        return joints, valid
+
 
 
     def limits(self, knee_deg, hip_deg, abad_deg):
@@ -138,3 +190,13 @@ class Kinematics:
         else:
             #print(f'knee: {knee_deg:.2f}, hip: {hip_deg:.2f}, abad: {abad_deg:.2f} ')
             return False
+
+    def limits_batch(self, knee_deg, hip_deg, abad_deg):
+        """limits for arrays of angles, returns a boolean array."""
+        return ((150 > hip_deg-knee_deg) & (hip_deg-knee_deg > 42) &
+                ((180 - self.Hip_Home_Angle_in_Cad_Deg - self.range / 2) < hip_deg) &
+                (hip_deg < (180 - self.Hip_Home_Angle_in_Cad_Deg + self.range / 2)) &
+                ((self.Abad_Home_Angle_in_Cad_Deg - self.range / 2) < abad_deg) &
+                (abad_deg < (self.Abad_Home_Angle_in_Cad_Deg + self.range / 2)) &
+                ((180 - self.Knee_Home_Angle_in_Cad_Deg - self.range / 2) < knee_deg) &
+                (knee_deg < (180 - self.Knee_Home_Angle_in_Cad_Deg + self.range / 2)))
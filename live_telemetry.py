@@ -0,0 +1,208 @@
+"""Latest state of every controller, published in shared memory.
+
+A TelemetryPublisher installed as bus.publisher (or with --publish)
+copies the commanded and measured state of each controller into a
+multiprocessing.shared_memory block at the end of every bus cycle.
+Any number of local processes can sample it with a TelemetryReader,
+without sending anything on the bus and without the control loop
+waiting on them:
+
+    python example_Trot.py --publish moteus
+    python live_telemetry.py moteus
+
+The block holds a sequence counter and one SLOT per controller ID.  The
+writer makes the counter odd while it updates the slots and even again
+when done, readers retry until they copied the slots between two equal
+even values (a seqlock), so a snapshot is never torn.  A publisher that
+died in the middle of an update leaves the counter odd, readers give up
+after READ_TIMEOUT_S and flag the snapshot as torn.
+"""
+import argparse
+import math
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+from telemetry_log import COMMANDED_FIELDS
+from telemetry_log import MEASURED_FIELDS
+from telemetry_log import measured
+
+MAGIC = b'MFDLIVE1'
+# Magic, sequence counter.
+HEADER = struct.Struct('<8sQ')
+SEQUENCE_OFFSET = 8
+SLOTS = 128
+
+# Per controller: bus tick and ID, then the time and values of the last
+# command and of the last reply.
+SLOT_HEADER = struct.Struct('<IB3x')
+COMMANDED = struct.Struct('<d{}f'.format(len(COMMANDED_FIELDS)))
+MEASURED = struct.Struct('<d{}f'.format(len(MEASURED_FIELDS)))
+COMMANDED_OFFSET = SLOT_HEADER.size
+MEASURED_OFFSET = COMMANDED_OFFSET + COMMANDED.size
+SLOT_SIZE = MEASURED_OFFSET + MEASURED.size
+SIZE = HEADER.size + SLOTS * SLOT_SIZE
+SLOTS_DATA = struct.Struct('<{}s'.format(SLOTS * SLOT_SIZE))
+
+_SEQUENCE = struct.Struct('<Q')
+
+# Readers spin this many times on an update in progress, then sleep
+# between retries until READ_TIMEOUT_S is up.
+SPIN_TRIES = 100
+READ_TIMEOUT_S = 0.01
+
+
+def read_seqlock(buffer, sequence_offset, layout, offset, timeout=READ_TIMEOUT_S):
+    """layout.unpack_from(buffer, offset), copied under the seqlock at sequence_offset.
+
+    Retries on an update in progress as described above, with timeout
+    in place of READ_TIMEOUT_S, 0 to give up after spinning.  Returns
+    None if no consistent copy could be made.
+    """
+    deadline = None
+    tries = 0
+    while True:
+        before, = _SEQUENCE.unpack_from(buffer, sequence_offset)
+        if not before & 1:
+            values = layout.unpack_from(buffer, offset)
+            after, = _SEQUENCE.unpack_from(buffer, sequence_offset)
+            if before == after:
+                return values
+        tries += 1
+        if tries >= SPIN_TRIES:
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + timeout
+            if now >= deadline:
+                return None
+            time.sleep(0.0001)
+
+
+class TelemetryPublisher:
+    """Writer side, creates (or takes over) the named block."""
+
+    def __init__(self, name='moteus_telemetry'):
+        self.name = name
+        try:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=SIZE)
+        except FileExistsError:
+            # Left behind by a control process that didn't exit cleanly.
+            self.memory = shared_memory.SharedMemory(name)
+        self.buffer = self.memory.buf
+        self.buffer[:SIZE] = bytes(SIZE)
+        HEADER.pack_into(self.buffer, 0, MAGIC, 0)
+        self.sequence = 0
+        self.tick = 0
+
+    def record(self, commands, results):
+        """Publishes one bus cycle."""
+        buffer = self.buffer
+        now = time.monotonic()
+        self.sequence += 1
+        _SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+        for command, result in zip(commands, results):
+            slot = HEADER.size + command.target * SLOT_SIZE
+            SLOT_HEADER.pack_into(buffer, slot, self.tick, command.target)
+            if command.values is not None:
+                COMMANDED.pack_into(buffer, slot + COMMANDED_OFFSET, now, *command.values)
+            if result is not None:
+                MEASURED.pack_into(buffer, slot + MEASURED_OFFSET, now, *measured(command, result))
+        self.sequence += 1
+        _SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+        self.tick += 1
+
+    def close(self):
+        if self.memory is None:
+            return
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+
+
+class TelemetryReader:
+    """Reader side, attaches to a block created by a TelemetryPublisher.
+
+    The block belongs to the publisher, so by default this process's
+    resource tracker is told to leave it alone.  Pass untrack=False
+    from a process that shares its tracker with the publisher, one that
+    started it with multiprocessing.
+    """
+
+    def __init__(self, name='moteus_telemetry', untrack=True):
+        self.name = name
+        # Whether the last snapshot could not be copied consistently.
+        self.torn = False
+        self.memory = shared_memory.SharedMemory(name)
+        if untrack:
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+        if bytes(self.memory.buf[:len(MAGIC)]) != MAGIC:
+            raise RuntimeError('{} is not a live telemetry block'.format(name))
+
+    def __copy(self):
+        buffer = self.memory.buf
+        values = read_seqlock(buffer, SEQUENCE_OFFSET, SLOTS_DATA, HEADER.size)
+        self.torn = values is None
+        if values is None:
+            values = SLOTS_DATA.unpack_from(buffer, HEADER.size)
+        return values[0]
+
+    def snapshot(self):
+        """Returns {controller ID: state dict} for every controller seen so far.
+
+        Each state has the tick it was last updated on, command_time and
+        the COMMANDED_FIELDS prefixed with cmd_, and reply_time and the
+        MEASURED_FIELDS prefixed with meas_.  Times are time.monotonic().
+        If the publisher stopped in the middle of an update the snapshot
+        may mix two updates, torn is then set.
+        """
+        data = self.__copy()
+        result = {}
+        for controller_ID in range(SLOTS):
+            slot = controller_ID * SLOT_SIZE
+            tick, slot_ID = SLOT_HEADER.unpack_from(data, slot)
+            if slot_ID != controller_ID or controller_ID == 0:
+                continue
+            command_time, *commanded = COMMANDED.unpack_from(data, slot + COMMANDED_OFFSET)
+            reply_time, *values = MEASURED.unpack_from(data, slot + MEASURED_OFFSET)
+            state = {'tick': tick,
+                     'command_time': command_time if command_time else math.nan,
+                     'reply_time': reply_time if reply_time else math.nan}
+            state.update(zip(['cmd_' + name for name in COMMANDED_FIELDS], commanded))
+            state.update(zip(['meas_' + name for name in MEASURED_FIELDS], values))
+            result[controller_ID] = state
+        return result
+
+    def close(self):
+        self.memory.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('name', type=str, nargs='?', default='moteus_telemetry', help='shared memory block')
+    parser.add_argument('--rate', type=float, default=10., help='updates per second')
+    args = parser.parse_args()
+
+    reader = TelemetryReader(args.name)
+    try:
+        while True:
+            now = time.monotonic()
+            snapshot = reader.snapshot()
+            if reader.torn:
+                print('publisher stopped in the middle of an update, values may be inconsistent')
+            for controller_ID, state in snapshot.items():
+                print('{:3d} tick {:8d}  Pos: {: 8.2f}deg  Vel: {: 8.2f}dps  Torque: {: 6.2f}Nm  '
+                      'Temp: {: 3.0f}C  Voltage: {: 5.1f}V  age {: 6.3f}s'.format(
+                        controller_ID, state['tick'], state['meas_position'] * 360.0,
+                        state['meas_velocity'] * 360.0, state['meas_torque'], state['meas_temperature'],
+                        state['meas_voltage'], now - state['reply_time']))
+            print()
+            time.sleep(1 / args.rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Where the time of a control loop goes, phase by phase.
+
+A LoopProfiler is told where a tick starts and where each of its
+phases ends, and keeps the duration of every phase of every tick in a
+preallocated ring.  Recording is a clock read and an add, nothing is
+printed while the loop runs.  The report, percentiles of every phase
+and a histogram of the tick time, is printed at exit and whenever the
+process gets SIGUSR1:
+
+    profiler = LoopProfiler(('trajectory', 'ik'))
+    while True:
+        profiler.tick()
+        ...
+        profiler.mark('trajectory')
+        knee, hip, abad = kinematics.ik(x, y, z)
+        profiler.mark('ik')
+        profiler.cycle(bus, [...])
+        loop.wait()
+
+    kill -USR1 <pid>
+
+mark(phase) charges the time since the previous mark to phase, a phase
+marked more than once per tick adds up.  cycle() runs a bus cycle and
+splits it into send, reply (waiting for the replies) and parse, using
+the bus's FrameTimings; the unmarked time before it goes to other.
+Whatever is left when the next tick starts, normally the sleep of the
+rate loop, goes to wait.
+"""
+import array
+import atexit
+import math
+import signal
+import sys
+import time
+
+import numpy as np
+
+from moteus_fdcan_adapter import percentile
+
+BUS_PHASES = ('other', 'send', 'reply', 'parse')
+
+
+class LoopProfiler:
+    """Per-phase durations of the last size ticks of a loop, in ns.
+
+    With report_on_exit the report is printed to file at exit, and
+    signum (None to not install a handler) prints it on demand.
+    """
+
+    def __init__(self, phases=(), size=65536, report_on_exit=True, signum=signal.SIGUSR1, file=None):
+        self.phases = tuple(phases) + tuple(phase for phase in BUS_PHASES if phase not in phases) + ('wait',)
+        self.columns = {phase: column for column, phase in enumerate(self.phases)}
+        # One row per tick: the phases, then the whole tick.
+        self.width = len(self.phases) + 1
+        self.size = size
+        self.samples = array.array('q', bytes(8 * self.width * size))
+        self.file = file
+        self.count = 0
+        self.row = 0
+        self.tick_start = None
+        self.last = None
+        self.start_ns = None
+        if report_on_exit:
+            atexit.register(self.report)
+        if signum is not None:
+            signal.signal(signum, self.__on_signal)
+
+    def __on_signal(self, signum, frame):
+        self.report()
+
+    def tick(self):
+        """Ends the running tick, if any, and starts the next one."""
+        now = time.perf_counter_ns()
+        if self.tick_start is None:
+            self.start_ns = now
+        else:
+            samples = self.samples
+            row = self.row
+            samples[row + self.columns['wait']] += now - self.last
+            samples[row + self.width - 1] = now - self.tick_start
+            self.count += 1
+            self.row = row = (self.count % self.size) * self.width
+            for column in range(self.width):
+                samples[row + column] = 0
+        self.tick_start = self.last = now
+
+    def mark(self, phase):
+        """Charges the time since the previous mark (or the tick start) to phase."""
+        now = time.perf_counter_ns()
+        if self.tick_start is not None:
+            self.samples[self.row + self.columns[phase]] += now - self.last
+        self.last = now
+
+    def cycle(self, bus, commands, timeout=None):
+        """bus.cycle(commands, timeout), profiled as the send, reply and parse phases."""
+        timings = bus.timings
+        if timings is None:
+            timings = bus.enable_timings()
+        count = timings.count
+        try:
+            return bus.cycle(commands, timeout)
+        finally:
+            # Nothing is recorded when sending failed.
+            if self.tick_start is not None and timings.count != count:
+                start, written, _, received, parsed = timings.last()
+                start = int(start * 1e9)
+                written = int(written * 1e9)
+                received = int(received * 1e9)
+                parsed = int(parsed * 1e9)
+                samples = self.samples
+                columns = self.columns
+                samples[self.row + columns['other']] += start - self.last
+                samples[self.row + columns['send']] += written - start
+                samples[self.row + columns['reply']] += received - written
+                samples[self.row + columns['parse']] += parsed - received
+                self.last = parsed
+
+    def durations(self):
+        """Finished ticks, oldest first, as a (ticks, phases + 1) array of seconds.
+
+        The last column is the whole tick.
+        """
+        count = min(self.count, self.size)
+        rows = np.frombuffer(self.samples, dtype=np.int64).reshape(self.size, self.width)
+        order = np.arange(self.count - count, self.count) % self.size
+        return rows[order] * 1e-9
+
+    def report(self, file=None, points=(50, 90, 99, 100), bins=20):
+        """Prints the percentiles of every phase and a histogram of the tick time."""
+        file = file if file is not None else (self.file if self.file is not None else sys.stderr)
+        durations = self.durations()
+        if not len(durations):
+            print('loop profile: no ticks', file=file)
+            return
+        ticks = durations[:, -1]
+        elapsed = (self.tick_start - self.start_ns) * 1e-9
+        print('loop profile: {} ticks in {:.1f}s, {:.1f} ticks/s, last {} ticks:'.format(
+            self.count, elapsed, self.count / elapsed, len(durations)), file=file)
+        print('  {:10s} {:>9s} '.format('phase [ms]', 'mean') +
+              ' '.join('{:>9s}'.format('p{}'.format(point) if point < 100 else 'max') for point in points) +
+              ' {:>6s}'.format('share'), file=file)
+        total = ticks.sum()
+        for column, phase in enumerate(self.phases + ('tick',)):
+            values = durations[:, column]
+            ordered = np.sort(values)
+            print('  {:10s} {:9.3f} '.format(phase, values.mean() * 1e3) +
+                  ' '.join('{:9.3f}'.format(percentile(ordered, point) * 1e3) for point in points) +
+                  ' {:5.1f}%'.format(100 * values.sum() / total if total else math.nan), file=file)
+        counts, edges = np.histogram(ticks * 1e3, bins=bins)
+        print('  tick time histogram [ms]:', file=file)
+        for low, high, count in zip(edges, edges[1:], counts):
+            print('  {:8.3f}-{:8.3f} {:7d} {}'.format(
+                low, high, count, '#' * int(math.ceil(50 * count / counts.max()))), file=file)
+        file.flush()
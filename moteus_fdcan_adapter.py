@@ -1,9 +1,19 @@
 import argparse
+import array
+import asyncio
+import binascii
+import collections
+import concurrent.futures
 import enum
+import errno
 import io
 import math
+import select
 import serial
+import socket
 import struct
+import threading
+import time
 
 class MoteusReg():
     # These constants can be found in:
@@ -13,6 +23,8 @@ class MoteusReg():
     INT16 = 1
     INT32 = 2
     F32 = 3
+    # Resolution for a register that is left out of the frame entirely.
+    IGNORE = None
 
     WRITE_BASE = 0x00
     READ_BASE = 0x10
@@ -46,6 +58,125 @@ class MoteusReg():
     MOTEUS_REG_MAX_TORQUE = 0x25
 
 
+# Physical value of one count in the int8, int16 and int32 encodings of
+# each register, see "register command set" in the moteus reference.
+# float32 values are always sent as-is.
+REGISTER_SCALES = {
+    MoteusReg.MOTEUS_REG_MODE: (1, 1, 1),
+    MoteusReg.MOTEUS_REG_POSITION: (0.01, 0.0001, 0.00001),
+    MoteusReg.MOTEUS_REG_VELOCITY: (0.1, 0.00025, 0.00001),
+    MoteusReg.MOTEUS_REG_TORQUE: (0.5, 0.01, 0.001),
+    MoteusReg.MOTEUS_REG_Q_A: (1.0, 0.1, 0.001),
+    MoteusReg.MOTEUS_REG_D_A: (1.0, 0.1, 0.001),
+    MoteusReg.MOTEUS_REG_V: (0.5, 0.1, 0.001),
+    MoteusReg.MOTEUS_REG_TEMP_C: (1.0, 0.1, 0.001),
+    MoteusReg.MOTEUS_REG_FAULT: (1, 1, 1),
+    MoteusReg.MOTEUS_REG_POS_POSITION: (0.01, 0.0001, 0.00001),
+    MoteusReg.MOTEUS_REG_POS_VELOCITY: (0.1, 0.00025, 0.00001),
+    MoteusReg.MOTEUS_REG_POS_TORQUE: (0.5, 0.01, 0.001),
+    MoteusReg.MOTEUS_REG_POS_KP: (1 / 127, 1 / 32767, 1 / 2147483647),
+    MoteusReg.MOTEUS_REG_POS_KD: (1 / 127, 1 / 32767, 1 / 2147483647),
+    MoteusReg.MOTEUS_REG_MAX_TORQUE: (0.5, 0.01, 0.001),
+}
+
+# Largest magnitude of each integer type.  The most negative value of
+# each type is reserved to mean NaN.
+_INT_LIMITS = {
+    MoteusReg.INT8: 127,
+    MoteusReg.INT16: 32767,
+    MoteusReg.INT32: 2147483647,
+}
+
+
+def scale_of(register, field_type):
+    if field_type == MoteusReg.F32:
+        return None
+    return REGISTER_SCALES.get(register, (1, 1, 1))[field_type]
+
+
+def to_int(value, scale, field_type):
+    limit = _INT_LIMITS[field_type]
+    if math.isnan(value):
+        return -limit - 1
+    counts = value / scale
+    if counts >= limit:
+        return limit
+    if counts <= -limit:
+        return -limit
+    return round(counts)
+
+
+def from_int(value, scale, field_type):
+    if value == -_INT_LIMITS[field_type] - 1:
+        return math.nan
+    return value * scale
+
+
+class QueryResolution:
+    """Register types used for each field read back from a controller.
+
+    Smaller types make shorter frames at the cost of precision, see
+    REGISTER_SCALES.  MoteusReg.IGNORE leaves the register out.
+    """
+
+    def __init__(self, mode=MoteusReg.INT8, position=MoteusReg.F32, velocity=MoteusReg.F32,
+                 torque=MoteusReg.F32, q_current=MoteusReg.IGNORE, d_current=MoteusReg.IGNORE,
+                 voltage=MoteusReg.INT8, temperature=MoteusReg.INT8, fault=MoteusReg.INT8):
+        self.mode = mode
+        self.position = position
+        self.velocity = velocity
+        self.torque = torque
+        self.q_current = q_current
+        self.d_current = d_current
+        self.voltage = voltage
+        self.temperature = temperature
+        self.fault = fault
+
+    def fields(self):
+        return [
+            (MoteusReg.MOTEUS_REG_MODE, self.mode),
+            (MoteusReg.MOTEUS_REG_POSITION, self.position),
+            (MoteusReg.MOTEUS_REG_VELOCITY, self.velocity),
+            (MoteusReg.MOTEUS_REG_TORQUE, self.torque),
+            (MoteusReg.MOTEUS_REG_Q_A, self.q_current),
+            (MoteusReg.MOTEUS_REG_D_A, self.d_current),
+            (MoteusReg.MOTEUS_REG_V, self.voltage),
+            (MoteusReg.MOTEUS_REG_TEMP_C, self.temperature),
+            (MoteusReg.MOTEUS_REG_FAULT, self.fault),
+        ]
+
+    def plan(self):
+        return QueryPlan(self.fields())
+
+
+class PositionResolution:
+    """Register types used for each field of a position mode command.
+
+    MoteusReg.IGNORE leaves the register out of the frame, in which case
+    the controller uses its own default for that field.  Values from
+    earlier frames are not kept.
+    """
+
+    def __init__(self, position=MoteusReg.F32, velocity=MoteusReg.F32, ff_torque=MoteusReg.F32,
+                 kp_scale=MoteusReg.F32, kd_scale=MoteusReg.F32, max_torque=MoteusReg.F32):
+        self.position = position
+        self.velocity = velocity
+        self.ff_torque = ff_torque
+        self.kp_scale = kp_scale
+        self.kd_scale = kd_scale
+        self.max_torque = max_torque
+
+    def fields(self):
+        return [
+            (MoteusReg.MOTEUS_REG_POS_POSITION, self.position),
+            (MoteusReg.MOTEUS_REG_POS_VELOCITY, self.velocity),
+            (MoteusReg.MOTEUS_REG_POS_TORQUE, self.ff_torque),
+            (MoteusReg.MOTEUS_REG_POS_KP, self.kp_scale),
+            (MoteusReg.MOTEUS_REG_POS_KD, self.kd_scale),
+            (MoteusReg.MOTEUS_REG_MAX_TORQUE, self.max_torque),
+        ]
+
+
 class MoteusMode(enum.IntEnum):
     STOPPED = 0
     FAULT = 1
@@ -58,42 +189,1301 @@ class MoteusMode(enum.IntEnum):
     TIMEOUT = 11
     ZERO_VEL = 12
 
+class Telemetry:
+    """Typed, reusable record of the state reported by one controller.
+
+    Controllers created with telemetry=True decode every reply into one
+    Telemetry in place and return it, so a steady-state loop builds no
+    dicts.  Fields are in physical units (rev, rev/s, Nm, A, V, C)
+    whatever the register resolution, NaN until first read.  The record
+    can also be indexed like the old reply dicts,
+    record[MoteusReg.MOTEUS_REG_POSITION], but voltage is in volts.
+    Use copy() to keep a sample past the next reply.
+    """
+    __slots__ = ('mode', 'position', 'velocity', 'torque', 'q_current', 'd_current',
+                 'voltage', 'temperature', 'fault')
+
+    FIELDS = {
+        MoteusReg.MOTEUS_REG_MODE: 'mode',
+        MoteusReg.MOTEUS_REG_POSITION: 'position',
+        MoteusReg.MOTEUS_REG_VELOCITY: 'velocity',
+        MoteusReg.MOTEUS_REG_TORQUE: 'torque',
+        MoteusReg.MOTEUS_REG_Q_A: 'q_current',
+        MoteusReg.MOTEUS_REG_D_A: 'd_current',
+        MoteusReg.MOTEUS_REG_V: 'voltage',
+        MoteusReg.MOTEUS_REG_TEMP_C: 'temperature',
+        MoteusReg.MOTEUS_REG_FAULT: 'fault',
+    }
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, math.nan)
+
+    def __getitem__(self, register):
+        return getattr(self, self.FIELDS[register])
+
+    def get(self, register, default=None):
+        name = self.FIELDS.get(register)
+        return default if name is None else getattr(self, name)
+
+    def __contains__(self, register):
+        return register in self.FIELDS
+
+    def keys(self):
+        return self.FIELDS.keys()
+
+    def items(self):
+        return [(register, getattr(self, name)) for register, name in self.FIELDS.items()]
+
+    def update(self, values):
+        for register, value in values.items():
+            name = self.FIELDS.get(register)
+            if name is not None:
+                setattr(self, name, value)
+
+    def copy(self):
+        result = Telemetry()
+        for name in self.__slots__:
+            setattr(result, name, getattr(self, name))
+        return result
+
+    def __repr__(self):
+        return 'Telemetry({})'.format(', '.join(
+            '{}={}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def encode_varuint(value):
+    result = bytearray()
+    while True:
+        this_byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(this_byte | 0x80)
+        else:
+            result.append(this_byte)
+            return bytes(result)
+
+
+def block_opcode(base, field_type, start_reg, count):
+    result = bytes([base | (field_type << 2) | (count if count < 4 else 0)])
+    if count >= 4:
+        result += encode_varuint(count)
+    return result + encode_varuint(start_reg)
+
+
+def group_registers(fields):
+    """Turns (register, field_type) pairs into (field_type, start_register, count) blocks.
+
+    Consecutive registers of the same type share one block, IGNOREd
+    registers are dropped.
+    """
+    blocks = []
+    for register, field_type in sorted(field for field in fields if field[1] is not None):
+        if blocks and blocks[-1][0] == field_type and blocks[-1][1] + blocks[-1][2] == register:
+            blocks[-1][2] += 1
+        else:
+            blocks.append([field_type, register, 1])
+    return [tuple(block) for block in blocks]
+
+
+def encode_read(blocks):
+    return b''.join([block_opcode(MoteusReg.READ_BASE, *block) for block in blocks])
+
+
+# Valid CAN-FD payload lengths.
+CANFD_LENGTHS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
+_PADDED_LENGTHS = [next(length for length in CANFD_LENGTHS if length >= size) for size in range(65)]
+
+
+def pad_frame(data):
+    """Pads a register frame with NOPs up to the next valid CAN-FD length."""
+    return data + bytes([MoteusReg.NOP]) * (_PADDED_LENGTHS[len(data)] - len(data))
+
+
+class ReplyLayout:
+    """Fixed-layout decoder for a reply to a known set of register reads.
+
+    blocks is a list of (field_type, start_register, count) tuples, in
+    the order they were requested.  The whole reply, opcode bytes
+    included, is unpacked with one precompiled Struct.  With scaled=True
+    integer registers are converted to physical units using
+    REGISTER_SCALES, otherwise the raw register values are returned.
+    """
+    _FORMAT_CHARS = {
+        MoteusReg.INT8: 'b',
+        MoteusReg.INT16: 'h',
+        MoteusReg.INT32: 'i',
+        MoteusReg.F32: 'f',
+    }
+
+    def __init__(self, blocks, scaled=False):
+        self.blocks = list(blocks)
+        if not self.blocks:
+            raise ValueError('a reply layout needs at least one register to read')
+        opcodes = []
+        fmt = '<'
+        registers = []
+        scales = []
+        offset = 0
+        for field_type, start_reg, count in self.blocks:
+            header = block_opcode(MoteusReg.REPLY_BASE, field_type, start_reg, count)
+            opcodes.append((offset, header))
+            fmt += '{}x{}{}'.format(len(header), count, self._FORMAT_CHARS[field_type])
+            registers.extend(range(start_reg, start_reg + count))
+            for register in range(start_reg, start_reg + count):
+                scale = scale_of(register, field_type)
+                scales.append(None if scale is None else (scale, -_INT_LIMITS[field_type] - 1))
+            offset += len(header) + count * MoteusReg._TYPE_STRUCTS[field_type].size
+        self.scaled = scaled
+        self.scales = scales if scaled else None
+        # Telemetry records are always filled in physical units.
+        self.record_fields = [(Telemetry.FIELDS.get(register), scale)
+                              for register, scale in zip(registers, scales)]
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.prefix = opcodes[0][1]
+        self.opcodes = opcodes[1:]
+        self.registers = tuple(registers)
+
+    def matches(self, data):
+        if len(data) < self.size or not data.startswith(self.prefix):
+            return False
+        for offset, header in self.opcodes:
+            if data[offset:offset + len(header)] != header:
+                return False
+        # CAN-FD frames are padded to a valid length with NOPs.
+        return data.count(MoteusReg.NOP, self.size) == len(data) - self.size
+
+    def decode(self, data):
+        values = self.struct.unpack_from(data)
+        if self.scales is not None:
+            values = [value if scale is None else (math.nan if value == scale[1] else value * scale[0])
+                      for value, scale in zip(values, self.scales)]
+        return dict(zip(self.registers, values))
+
+    def decode_into(self, data, record):
+        for (name, scale), value in zip(self.record_fields, self.struct.unpack_from(data)):
+            if name is None:
+                continue
+            if scale is not None:
+                value = math.nan if value == scale[1] else value * scale[0]
+            setattr(record, name, value)
+        return record
+
+
+class QueryPlan:
+    """A compiled choice of registers to read back with a command.
+
+    registers is a list of (register, field_type) pairs, for instance
+    [(MoteusReg.MOTEUS_REG_V, MoteusReg.INT8)] to read only the bus
+    voltage.  The read opcodes and the matching ReplyLayout are built
+    once, so build plans up front and reuse them in the loop.
+    """
+
+    def __init__(self, registers, scaled=True):
+        self.registers = list(registers)
+        self.blocks = group_registers(self.registers)
+        self.frame = encode_read(self.blocks)
+        self.layout = ReplyLayout(self.blocks, scaled=scaled)
+
+    def decode(self, data):
+        return self.layout.decode(data)
+
+
+# What get_data and set_position(get_data=True) have always read: 4
+# float32 registers starting at mode (mode, position, velocity, torque)
+# and 3 int8 registers starting at voltage (voltage, temperature,
+# fault), returned as raw register values.
+DEFAULT_QUERY = QueryPlan([
+    (MoteusReg.MOTEUS_REG_MODE, MoteusReg.F32),
+    (MoteusReg.MOTEUS_REG_POSITION, MoteusReg.F32),
+    (MoteusReg.MOTEUS_REG_VELOCITY, MoteusReg.F32),
+    (MoteusReg.MOTEUS_REG_TORQUE, MoteusReg.F32),
+    (MoteusReg.MOTEUS_REG_V, MoteusReg.INT8),
+    (MoteusReg.MOTEUS_REG_TEMP_C, MoteusReg.INT8),
+    (MoteusReg.MOTEUS_REG_FAULT, MoteusReg.INT8),
+], scaled=False)
+
+REPLY_LAYOUTS = [DEFAULT_QUERY.layout]
+
+
+class FrameTemplate:
+    """Preallocated encoder for one fixed frame layout of one controller.
+
+    The constant opcode bytes and the "can send" header are laid down
+    once.  Encoding only packs the variable values into the existing
+    buffer with a cached Struct and hexlifies it in a single pass.
+    """
+
+    def __init__(self, target, reply, prefix, fmt='<', suffix=b''):
+        self.reply = reply
+        self.struct = struct.Struct(fmt)
+        self.offset = len(prefix)
+        self.buf = bytearray(prefix + bytes(self.struct.size) + suffix)
+        self.header = "can send {:02x}{:02x} ".format(
+            0x80 if reply else 0x00, target).encode('latin1')
+
+    def encode(self, *values):
+        """Returns (frame, line) where line is ready to write to the adapter."""
+        self.struct.pack_into(self.buf, self.offset, *values)
+        return bytes(self.buf), self.header + binascii.hexlify(self.buf) + b'\n'
+
+
+class ScaledFrameTemplate:
+    """FrameTemplate for register writes that mix register types.
+
+    fields is a list of (register, field_type) pairs.  encode() takes
+    one value per register starting at first_register, in float32
+    units, and converts the ones sent as integers using REGISTER_SCALES.
+    """
+
+    _FORMAT_CHARS = ReplyLayout._FORMAT_CHARS
+
+    def __init__(self, target, reply, prefix, fields, first_register, suffix=b''):
+        self.reply = reply
+        buf = bytearray(prefix)
+        self.segments = []
+        for field_type, start_reg, count in group_registers(fields):
+            buf += block_opcode(MoteusReg.WRITE_BASE, field_type, start_reg, count)
+            block_struct = struct.Struct('<' + self._FORMAT_CHARS[field_type] * count)
+            conversions = [(register - first_register, scale_of(register, field_type), field_type)
+                           for register in range(start_reg, start_reg + count)]
+            self.segments.append((block_struct, len(buf), conversions))
+            buf += bytes(block_struct.size)
+        buf += suffix
+        self.buf = buf
+        self.header = "can send {:02x}{:02x} ".format(
+            0x80 if reply else 0x00, target).encode('latin1')
+
+    def encode(self, *values):
+        """Returns (frame, line) where line is ready to write to the adapter."""
+        for block_struct, offset, conversions in self.segments:
+            block_struct.pack_into(self.buf, offset, *[
+                values[index] if scale is None else to_int(values[index], scale, field_type)
+                for index, scale, field_type in conversions])
+        return bytes(self.buf), self.header + binascii.hexlify(self.buf) + b'\n'
+
+
+class Command:
+    """A single frame built by one of the Controller.make_* methods.
+
+    Commands are executed with FdcanusbBus.cycle, which sends a whole
+    batch before reading any of the replies.  values holds the position
+    mode values of a position command, for logging.
+    """
+    __slots__ = ('controller', 'frame', 'line', 'reply', 'print_data', 'layout', 'values')
+
+    def __init__(self, controller, frame, line, reply, print_data=False, layout=None, values=None):
+        self.controller = controller
+        self.frame = frame
+        self.line = line
+        self.reply = reply
+        self.print_data = print_data
+        self.layout = layout
+        self.values = values
+
+    @property
+    def target(self):
+        return self.controller.target
+
+    def parse(self, data):
+        return self.controller.parse_frame(data, print_data=self.print_data, layout=self.layout)
+
+
+class ReplyTimeout(RuntimeError):
+    """Raised by a bus cycle when replies did not arrive before its deadline.
+
+    missing lists the controller IDs that didn't answer, results is the
+    cycle's result list with None in their place, so the replies that
+    did arrive can still be used.
+    """
+
+    def __init__(self, missing, results):
+        super().__init__('no reply from controller(s) {}'.format(
+            ', '.join(str(controller_ID) for controller_ID in missing)))
+        self.missing = missing
+        self.results = results
+
+
+def percentile(ordered, point):
+    """Nearest-rank percentile of an ascending sequence, NaN when it is empty."""
+    count = len(ordered)
+    if not count:
+        return math.nan
+    return ordered[min(count - 1, max(0, int(math.ceil(point / 100 * count)) - 1))]
+
+
+class FrameTimings:
+    """Fixed-size ring of perf_counter timestamps, one row per bus cycle.
+
+    Each row holds the STAGES of one cycle: before the write, after the
+    write, after the adapter OKs (NaN when a reader thread consumes
+    them, or on SocketCAN), after the last device reply and after
+    parsing.  The ring is preallocated and only written by the thread
+    running the cycles, so recording takes no lock and allocates
+    nothing.
+    """
+    STAGES = ('start', 'written', 'ok', 'rcv', 'parsed')
+    WIDTH = len(STAGES)
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.samples = array.array('d', bytes(8 * self.WIDTH * size))
+        self.count = 0
+
+    def record(self, start, written, ok, received, parsed):
+        row = (self.count % self.size) * self.WIDTH
+        samples = self.samples
+        samples[row] = start
+        samples[row + 1] = written
+        samples[row + 2] = ok
+        samples[row + 3] = received
+        samples[row + 4] = parsed
+        self.count += 1
+
+    def last(self):
+        """The latest row as a tuple in STAGES order, None before the first cycle."""
+        if not self.count:
+            return None
+        row = ((self.count - 1) % self.size) * self.WIDTH
+        return tuple(self.samples[row:row + self.WIDTH])
+
+    def rows(self):
+        """Recorded rows, oldest first, as tuples in STAGES order."""
+        width = self.WIDTH
+        first = max(0, self.count - self.size)
+        return [tuple(self.samples[(i % self.size) * width:(i % self.size) * width + width])
+                for i in range(first, self.count)]
+
+    def intervals(self, since='start', until='rcv'):
+        begin = self.STAGES.index(since)
+        end = self.STAGES.index(until)
+        return [row[end] - row[begin] for row in self.rows()
+                if not math.isnan(row[end]) and not math.isnan(row[begin])]
+
+    def percentiles(self, since='start', until='rcv', points=(50, 90, 99, 100)):
+        """Percentiles of the time between two stages, in seconds."""
+        ordered = sorted(self.intervals(since, until))
+        if not ordered:
+            return {}
+        return {point: percentile(ordered, point) for point in points}
+
+    def summary(self, points=(50, 90, 99, 100)):
+        """Percentiles of every consecutive stage interval and of the whole cycle."""
+        result = {}
+        for since, until in zip(self.STAGES, self.STAGES[1:]):
+            result['{}-{}'.format(since, until)] = self.percentiles(since, until, points)
+        result['start-parsed'] = self.percentiles('start', 'parsed', points)
+        return result
+
+    def dump(self, path):
+        """Writes the raw rows as CSV."""
+        with open(path, 'w') as f:
+            f.write(','.join(self.STAGES) + '\n')
+            for row in self.rows():
+                f.write(','.join(repr(value) for value in row) + '\n')
+
+
+class TelemetryGroup:
+    """Registers polled together, every `every` bus cycles.
+
+    offset shifts the cycles a group is due on, so several slow groups
+    can be spread out instead of all landing on the same cycle.
+    """
+
+    def __init__(self, registers, every=1, offset=0):
+        self.registers = list(registers)
+        self.every = every
+        self.offset = offset
+
+
+class TelemetryScheduler:
+    """Mixed-rate polling that rides on the queries a loop already sends.
+
+    Install one with bus.schedule(groups).  Every replying command built
+    without an explicit query_plan then reads the union of the groups
+    due on the current cycle, so slow registers cost a few extra bytes
+    every Nth cycle instead of a round trip of their own.  On cycles
+    with no group due the IDLE_REGISTERS are read, so that replying
+    commands still get a reply.  Each reply is cached per controller,
+    read it back with latest().
+    """
+    IDLE_REGISTERS = [(MoteusReg.MOTEUS_REG_MODE, MoteusReg.INT8)]
+
+    def __init__(self, groups):
+        self.groups = list(groups)
+        self.tick = 0
+        self.__plans = {}
+        self.__values = collections.defaultdict(dict)
+        self.__stamps = collections.defaultdict(dict)
+        self.plan = self.__plan_for_tick()
+
+    def __plan_for_tick(self):
+        due = tuple(index for index, group in enumerate(self.groups)
+                    if (self.tick + group.offset) % group.every == 0)
+        plan = self.__plans.get(due)
+        if plan is None:
+            registers = {}
+            for index in due:
+                registers.update(self.groups[index].registers)
+            plan = QueryPlan(registers.items() if registers else self.IDLE_REGISTERS)
+            self.__plans[due] = plan
+        return plan
+
+    def advance(self):
+        self.tick += 1
+        self.plan = self.__plan_for_tick()
+
+    def store(self, controller_ID, registers, result):
+        # Telemetry records only carry Telemetry.FIELDS, other registers
+        # read by controllers built with telemetry=True are not kept.
+        now = time.monotonic()
+        values = self.__values[controller_ID]
+        stamps = self.__stamps[controller_ID]
+        for register in registers:
+            value = result.get(register)
+            if value is not None:
+                values[register] = value
+                stamps[register] = now
+
+    def latest(self, controller_ID, register):
+        """Returns (value, age in seconds), (nan, inf) if never read."""
+        stamp = self.__stamps[controller_ID].get(register)
+        if stamp is None:
+            return math.nan, math.inf
+        return self.__values[controller_ID][register], time.monotonic() - stamp
+
+
+class CanBus:
+    """Transport interface that Controller commands are run through.
+
+    A transport implements two primitives:
+
+      send_batch(commands)     puts every command's frame on the bus and
+                               returns a receipt for receive_batch
+      receive_batch(commands, receipt, deadline)
+                               returns one binary reply payload per
+                               command, None for commands that don't
+                               ask for one or whose reply didn't arrive
+                               by the deadline
+
+    and optionally async_receive_batch.  Everything above that, cycle,
+    async_cycle, timeouts, late replies, the scheduler and timings, is
+    shared, so Controller code, encoders and decoders are the same on
+    FdcanusbBus, SocketcanBus and fdcanusb_simulator.SimulatorBus.
+    """
+
+    # Requests still waiting for a reply after this many seconds are
+    # assumed lost, so the next reply from that ID can't be given to them.
+    # Transports also forget them once the receive side was drained
+    # before a new request to that ID.
+    STALE_REPLY_S = 0.1
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.timings = None
+        self.misses = collections.Counter()
+        self.late_replies = 0
+        # Expiry times of replies still due from each ID, until the next
+        # request to that ID.
+        self._late = collections.defaultdict(collections.deque)
+        # Latest unclaimed reply payload for each source ID.
+        self.replies = {}
+        self.scheduler = None
+        # A telemetry_log.TelemetryLog that every cycle is recorded to,
+        # and a live_telemetry.TelemetryPublisher it is published with.
+        self.telemetry_log = None
+        self.publisher = None
+        # When the last batch was acknowledged, for transports that do.
+        self._ok_stamp = math.nan
+        self._async_lock = None
+
+    def controller(self, controller_ID, **kwargs):
+        return Controller(controller_ID, bus=self, **kwargs)
+
+    def schedule(self, groups):
+        """Installs a TelemetryScheduler polling the given TelemetryGroups."""
+        self.scheduler = TelemetryScheduler(groups)
+        return self.scheduler
+
+    def enable_timings(self, size=4096):
+        """Starts recording per-cycle stage timestamps into a FrameTimings ring."""
+        self.timings = FrameTimings(size)
+        return self.timings
+
+    def disable_timings(self):
+        self.timings = None
+
+    def _deadline(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    def _missed(self, target):
+        self.misses[target] += 1
+        self._late[target].append(time.monotonic() + self.STALE_REPLY_S)
+
+    def _accept(self, source, payload):
+        # Returns the source, or None if this is the late answer to a
+        # command that timed out.
+        late = self._late.get(source)
+        if late:
+            now = time.monotonic()
+            while late and late[0] < now:
+                late.popleft()
+            if late:
+                late.popleft()
+                self.late_replies += 1
+                return None
+        self.replies[source] = payload
+        return source
+
+    def send_batch(self, commands):
+        raise NotImplementedError()
+
+    def receive_batch(self, commands, receipt, deadline=None):
+        raise NotImplementedError()
+
+    async def async_receive_batch(self, commands, receipt, deadline=None):
+        return self.receive_batch(commands, receipt, deadline)
+
+    def _finish(self, commands, payloads):
+        missing = [command.target for command, payload in zip(commands, payloads)
+                   if command.reply and payload is None]
+        for target in missing:
+            self._missed(target)
+        scheduler = self.scheduler
+        try:
+            results = [None if payload is None else command.parse(payload)
+                       for command, payload in zip(commands, payloads)]
+            if scheduler is not None:
+                for command, result in zip(commands, results):
+                    if result is not None:
+                        scheduler.store(command.target, command.layout.registers, result)
+        finally:
+            # A reply that fails to parse mustn't hold up the schedule.
+            if scheduler is not None:
+                scheduler.advance()
+        if self.telemetry_log is not None:
+            self.telemetry_log.record(commands, results)
+        if self.publisher is not None:
+            self.publisher.record(commands, results)
+        if missing:
+            raise ReplyTimeout(missing, results)
+        return results
+
+    def cycle(self, commands, timeout=None):
+        """Send every command in one batch, then collect all the replies.
+
+        Returns a list with one entry per command: the parsed reply for
+        commands built with get_data=True (or make_query), else None.
+        Only one replying command per controller is allowed per cycle.
+        timeout, in seconds, overrides the bus timeout for this cycle.
+        """
+        deadline = self._deadline(timeout)
+        timings = self.timings
+        if timings is None:
+            return self._finish(commands, self.receive_batch(commands, self.send_batch(commands), deadline))
+        start = time.perf_counter()
+        receipt = self.send_batch(commands)
+        written = time.perf_counter()
+        payloads = self.receive_batch(commands, receipt, deadline)
+        received = time.perf_counter()
+        try:
+            return self._finish(commands, payloads)
+        finally:
+            timings.record(start, written, self._ok_stamp, received, time.perf_counter())
+
+    async def async_cycle(self, commands, timeout=None):
+        """asyncio version of cycle.
+
+        Waiting for replies is done through the event loop, so other
+        tasks run while they are in flight.  Concurrent callers are
+        serialized, each cycle owns the bus until its replies are in.
+        """
+        deadline = self._deadline(timeout)
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            return await self._async_exchange(commands, deadline)
+
+    async def _async_exchange(self, commands, deadline):
+        timings = self.timings
+        if timings is None:
+            receipt = self.send_batch(commands)
+            return self._finish(commands, await self.async_receive_batch(commands, receipt, deadline))
+        start = time.perf_counter()
+        receipt = self.send_batch(commands)
+        written = time.perf_counter()
+        payloads = await self.async_receive_batch(commands, receipt, deadline)
+        received = time.perf_counter()
+        try:
+            return self._finish(commands, payloads)
+        finally:
+            timings.record(start, written, self._ok_stamp, received, time.perf_counter())
+
+
+class FdcanusbBus(CanBus):
+    """Owns a single fdcanusb serial port and routes replies by CAN source ID.
+
+    Any number of Controller handles can share one bus.  Use
+    FdcanusbBus.shared(device) to get the process wide instance for a
+    device, or bus.controller(ID) to create a handle on a given bus.
+
+    With a timeout (per bus, or per cycle) a cycle never waits past its
+    deadline: controllers that didn't answer in time are counted in
+    bus.misses and reported by raising ReplyTimeout, and their replies,
+    should they still turn up before the next command to that
+    controller, are drained and discarded rather than paired with it.
+
+    By default replies are read by whoever is waiting for them.  After
+    start_reader() a background thread owns the receive side instead:
+    it matches every rcv line to the oldest outstanding request from
+    that source that is still waited for, so commands that don't ask
+    for data never wait at all.  Requests abandoned on timeout are
+    dropped when the next request to that controller is sent.
+    """
+    _shared = {}
+
+    def __init__(self, device='/dev/fdcanusb', timeout=None):
+        super().__init__(timeout)
+        self.device = device
+        self.serial = serial.Serial(port=device)
+        self._rx = bytearray()
+        self._rx_pos = 0
+        self._write_lock = threading.Lock()
+        self._reader = None
+        self._reader_running = False
+        self._pending = collections.defaultdict(collections.deque)
+        self._pending_lock = threading.Lock()
+        # Adapter OKs still due from a cycle that timed out.
+        self._owed_oks = 0
+        self.ok_count = 0
+        self.adapter_errors = collections.deque(maxlen=16)
+
+    @classmethod
+    def shared(cls, device='/dev/fdcanusb', timeout=None):
+        bus = cls._shared.get(device)
+        if bus is None:
+            bus = cls(device, timeout=timeout)
+            cls._shared[device] = bus
+        elif timeout is not None:
+            bus.timeout = timeout
+        return bus
+
+    def start_reader(self):
+        if self._reader is not None:
+            return
+        # The reader polls so that stop_reader() can join it.
+        self.serial.timeout = 0.05
+        self._reader_running = True
+        self._reader = threading.Thread(target=self.__reader_main, name='fdcanusb-reader', daemon=True)
+        self._reader.start()
+
+    def stop_reader(self):
+        if self._reader is None:
+            return
+        self._reader_running = False
+        self._reader.join()
+        self._reader = None
+        self.serial.timeout = None
+
+    def __reader_main(self):
+        while self._reader_running:
+            line = self.__next_line()
+            if line is None:
+                self._rx += self.serial.read(self.serial.in_waiting or 1)
+            elif line.startswith(b"OK"):
+                self.ok_count += 1
+            elif line.startswith(b"rcv"):
+                self.__dispatch(line)
+            else:
+                self.adapter_errors.append(line)
+                self.__fail_pending(RuntimeError("fdcanusb responded with: " + line.decode('latin1')))
+
+    def __fail_pending(self, error):
+        # There is no telling which request an adapter error belongs
+        # to, so everyone waiting gets it rather than waiting forever.
+        with self._pending_lock:
+            for pending in self._pending.values():
+                while pending:
+                    future = pending.popleft()
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(error)
+
+    def __dispatch(self, line):
+        fields = line.split(b" ")
+        source = (int(fields[1], 16) >> 8) & 0x7f
+        with self._pending_lock:
+            pending = self._pending.get(source)
+            while pending:
+                future = pending.popleft()
+                # Requests expire with their caller's deadline, see
+                # __collect_future.
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fields[2])
+                    return
+                # The caller gave up on it, a cancelled request never
+                # takes a reply.
+        self.replies[source] = fields[2]
+
+    def close(self):
+        self.stop_reader()
+        self.serial.close()
+        if FdcanusbBus._shared.get(self.device) is self:
+            del FdcanusbBus._shared[self.device]
+
+    def __next_line(self):
+        # Hand out the next complete line already in the receive
+        # buffer, or None if more bytes are needed.
+        rx = self._rx
+        while True:
+            end = rx.find(b'\n', self._rx_pos)
+            if end < 0:
+                if self._rx_pos:
+                    del rx[:self._rx_pos]
+                    self._rx_pos = 0
+                return None
+            line = bytes(rx[self._rx_pos:end])
+            self._rx_pos = end + 1
+            if self._rx_pos == len(rx):
+                rx.clear()
+                self._rx_pos = 0
+            if line:
+                return line
+
+    def readline(self, deadline=None):
+        # Pull whatever the adapter has buffered in one read and hand
+        # out complete lines from it, rather than a syscall per byte.
+        # Returns None if nothing complete arrived by the deadline.
+        while True:
+            line = self.__next_line()
+            if line is not None:
+                return line
+            if deadline is not None and not self.serial.in_waiting:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.serial.fileno()], [], [], remaining)[0]:
+                    return None
+            self._rx += self.serial.read(self.serial.in_waiting or 1)
+
+    async def async_readline(self, deadline=None):
+        while True:
+            line = self.__next_line()
+            if line is not None:
+                return line
+            if deadline is None:
+                await self.__wait_readable()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(self.__wait_readable(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+            self._rx += self.serial.read(self.serial.in_waiting or 1)
+
+    async def __wait_readable(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fd = self.serial.fileno()
+
+        def on_readable():
+            loop.remove_reader(fd)
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(fd, on_readable)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+
+    def route(self, line):
+        # "rcv <arbitration id> <hex data> ..." where the arbitration
+        # ID is (source << 8) | destination.  Returns the source, or
+        # None if this is the late answer to a command that timed out.
+        fields = line.split(b" ")
+        return self._accept((int(fields[1], 16) >> 8) & 0x7f, fields[2])
+
+    def __is_ok(self, line):
+        if line.startswith(b"OK"):
+            return True
+        if line.startswith(b"rcv"):
+            # A device reply overtook the adapter acknowledge.
+            self.route(line)
+            return False
+        raise RuntimeError("fdcanusb responded with: " +
+                           line.decode('latin1'))
+
+    def __is_reply_from(self, line, target):
+        if line.startswith(b"OK") and self._owed_oks:
+            self._owed_oks -= 1
+            return False
+        if not line.startswith(b"rcv"):
+            raise RuntimeError("unexpected response: " +
+                               line.decode('latin1'))
+        return self.route(line) == target
+
+    def read_ok(self, deadline=None):
+        """Reads up to the next adapter OK, returns False on timeout."""
+        while True:
+            line = self.readline(deadline)
+            if line is None:
+                return False
+            if self.__is_ok(line):
+                return True
+
+    async def async_read_ok(self, deadline=None):
+        while True:
+            line = await self.async_readline(deadline)
+            if line is None:
+                return False
+            if self.__is_ok(line):
+                return True
+
+    def wait_reply(self, target, deadline=None):
+        """Returns the next reply payload from target, None on timeout."""
+        while target not in self.replies:
+            line = self.readline(deadline)
+            if line is None:
+                return None
+            self.__is_reply_from(line, target)
+        return self.replies.pop(target)
+
+    async def async_wait_reply(self, target, deadline=None):
+        while target not in self.replies:
+            line = await self.async_readline(deadline)
+            if line is None:
+                return None
+            self.__is_reply_from(line, target)
+        return self.replies.pop(target)
+
+    def drain(self):
+        """Consumes, without blocking, whatever the adapter already sent.
+
+        Late OKs and replies from timed out cycles are discarded here,
+        anything else unclaimed ends up in bus.replies.
+        """
+        waiting = self.serial.in_waiting
+        if waiting:
+            self._rx += self.serial.read(waiting)
+        while True:
+            line = self.__next_line()
+            if line is None:
+                return
+            if line.startswith(b"OK"):
+                if self._owed_oks:
+                    self._owed_oks -= 1
+            elif line.startswith(b"rcv"):
+                self.route(line)
+            else:
+                self.adapter_errors.append(line)
+
+    def _missed(self, target):
+        if self._reader is None:
+            super()._missed(target)
+        else:
+            # The late reply will find its cancelled request instead.
+            self.misses[target] += 1
+
+    def __payloads(self, devices):
+        return [None if device is None else binascii.unhexlify(device) for device in devices]
+
+    def send_batch(self, commands):
+        """Writes every command in one write.
+
+        The receipt is the list of reply futures when a reader thread
+        is running, else None.
+        """
+        futures = None
+        if self._reader is not None:
+            futures = []
+            with self._pending_lock:
+                for command in commands:
+                    if command.reply:
+                        pending = self._pending[command.target]
+                        if pending:
+                            # Drop the requests whose callers gave up.
+                            live = [future for future in pending if not future.cancelled()]
+                            if len(live) != len(pending):
+                                pending.clear()
+                                pending.extend(live)
+                        future = concurrent.futures.Future()
+                        pending.append(future)
+                        futures.append(future)
+                    else:
+                        futures.append(None)
+        else:
+            if self._rx_pos < len(self._rx) or self.serial.in_waiting:
+                self.drain()
+            for command in commands:
+                if command.reply:
+                    self.replies.pop(command.target, None)
+                    # Late replies that weren't in by now are taken as
+                    # lost, or a missing controller would never recover.
+                    self._late.pop(command.target, None)
+        with self._write_lock:
+            self.serial.write(b''.join([command.line for command in commands]))
+        return futures
+
+    def __collect_future(self, future, deadline):
+        try:
+            if deadline is None:
+                return future.result()
+            return future.result(timeout=max(0., deadline - time.monotonic()))
+        except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError):
+            # If the reader already claimed the future its reply is
+            # being delivered right now, otherwise drop it.
+            if not future.cancel() and not future.cancelled():
+                return future.result()
+            return None
+
+    def receive_batch(self, commands, receipt, deadline=None):
+        if receipt is not None:
+            # The adapter OK is consumed by the reader thread.
+            self._ok_stamp = math.nan
+            return self.__payloads([None if future is None else self.__collect_future(future, deadline)
+                                    for future in receipt])
+
+        owed = self._owed_oks + len(commands)
+        self._owed_oks = 0
+        for i in range(owed):
+            if not self.read_ok(deadline):
+                self._owed_oks = owed - i
+                break
+        self._ok_stamp = time.perf_counter()
+        return self.__payloads([self.wait_reply(command.target, deadline) if command.reply else None
+                                for command in commands])
+
+    async def __async_collect_future(self, future, deadline):
+        # asyncio.wait neither raises nor cancels on timeout, so a
+        # CancelledError here is the task being cancelled.
+        try:
+            await asyncio.wait((asyncio.wrap_future(future),),
+                               timeout=None if deadline is None else max(0., deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        if not future.cancel() and not future.cancelled():
+            return future.result()
+        return None
+
+    async def async_receive_batch(self, commands, receipt, deadline=None):
+        if receipt is not None:
+            self._ok_stamp = math.nan
+            return self.__payloads([None if future is None
+                                    else await self.__async_collect_future(future, deadline)
+                                    for future in receipt])
+
+        owed = self._owed_oks + len(commands)
+        self._owed_oks = 0
+        for i in range(owed):
+            try:
+                ok = await self.async_read_ok(deadline)
+            except asyncio.CancelledError:
+                self._owed_oks = owed - i
+                raise
+            if not ok:
+                self._owed_oks = owed - i
+                break
+        self._ok_stamp = time.perf_counter()
+        devices = []
+        for command in commands:
+            device = None
+            if command.reply:
+                device = await self.async_wait_reply(command.target, deadline)
+            devices.append(device)
+        return self.__payloads(devices)
+
+    async def async_cycle(self, commands, timeout=None):
+        if self._reader is not None:
+            # Replies are matched to their requests by the reader, so
+            # concurrent cycles don't need to take turns.
+            return await self._async_exchange(commands, self._deadline(timeout))
+        return await super().async_cycle(commands, timeout)
+
+
+# SocketCAN flags and masks, from linux/can.h.
+CAN_EFF_FLAG = 0x80000000
+CAN_EFF_MASK = 0x1fffffff
+CANFD_BRS = 0x01
+
+
+class SocketcanBus(CanBus):
+    """Runs the same commands as FdcanusbBus on a Linux SocketCAN interface.
+
+    Frames are sent and received as binary CAN-FD frames, so there is
+    no hex encoding, no line parsing and no adapter OK to wait for.
+    This works on any CAN-FD capable interface, and on a vcan with
+    fdcanusb_simulator.py answering for testing:
+
+        sudo ip link add dev vcan0 type vcan
+        sudo ip link set vcan0 mtu 72 up
+        python fdcanusb_simulator.py --ids 1 2 3 --socketcan vcan0
+    """
+    _shared = {}
+
+    # struct canfd_frame: can_id, len, flags, two reserved bytes, data.
+    # Classic frames share the header and are shorter.
+    FRAME = struct.Struct('=IBBxx64s')
+    HEADER = struct.Struct('=IB')
+    DATA_OFFSET = 8
+
+    def __init__(self, interface='can0', timeout=None, bitrate_switch=True):
+        super().__init__(timeout)
+        self.interface = interface
+        self.flags = CANFD_BRS if bitrate_switch else 0
+        self.socket = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        self.socket.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FD_FRAMES, 1)
+        self.socket.bind((interface,))
+        self.socket.setblocking(False)
+
+    @classmethod
+    def shared(cls, interface='can0', timeout=None):
+        bus = cls._shared.get(interface)
+        if bus is None:
+            bus = cls(interface, timeout=timeout)
+            cls._shared[interface] = bus
+        elif timeout is not None:
+            bus.timeout = timeout
+        return bus
+
+    def close(self):
+        self.socket.close()
+        if SocketcanBus._shared.get(self.interface) is self:
+            del SocketcanBus._shared[self.interface]
+
+    def pack(self, command):
+        """The raw canfd_frame for a command."""
+        arbitration_id = (0x8000 if command.reply else 0) | command.target
+        if arbitration_id > 0x7ff:
+            arbitration_id |= CAN_EFF_FLAG
+        data = pad_frame(command.frame)
+        return self.FRAME.pack(arbitration_id, len(data), self.flags, data)
+
+    def __send(self, packet):
+        while True:
+            try:
+                self.socket.send(packet)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                    raise
+                # The interface queue is full, give it a moment to drain.
+                select.select([], [self.socket], [], 0.001)
+
+    def __accept_packet(self, packet):
+        can_id, size = self.HEADER.unpack_from(packet)
+        return self._accept(((can_id & CAN_EFF_MASK) >> 8) & 0x7f,
+                            packet[self.DATA_OFFSET:self.DATA_OFFSET + size])
+
+    def receive(self, deadline=None):
+        """Routes the next received frame, returns False on timeout."""
+        while True:
+            try:
+                packet = self.socket.recv(self.FRAME.size)
+            except BlockingIOError:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                select.select([self.socket], [], [], remaining)
+                continue
+            self.__accept_packet(packet)
+            return True
+
+    def drain(self):
+        """Consumes, without blocking, whatever was already received."""
+        while self.receive(0):
+            pass
+
+    def wait_reply(self, target, deadline=None):
+        """Returns the next reply payload from target, None on timeout."""
+        while target not in self.replies:
+            if not self.receive(deadline):
+                return None
+        return self.replies.pop(target)
+
+    async def async_wait_reply(self, target, deadline=None):
+        loop = asyncio.get_running_loop()
+        while target not in self.replies:
+            receive = loop.sock_recv(self.socket, self.FRAME.size)
+            if deadline is None:
+                packet = await receive
+            else:
+                try:
+                    packet = await asyncio.wait_for(receive, max(0., deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    return None
+            self.__accept_packet(packet)
+        return self.replies.pop(target)
+
+    def send_batch(self, commands):
+        self.drain()
+        for command in commands:
+            if command.reply:
+                self.replies.pop(command.target, None)
+                self._late.pop(command.target, None)
+            self.__send(self.pack(command))
+
+    def receive_batch(self, commands, receipt, deadline=None):
+        return [self.wait_reply(command.target, deadline) if command.reply else None
+                for command in commands]
+
+    async def async_receive_batch(self, commands, receipt, deadline=None):
+        payloads = []
+        for command in commands:
+            payload = None
+            if command.reply:
+                payload = await self.async_wait_reply(command.target, deadline)
+            payloads.append(payload)
+        return payloads
+
+
+def open_bus(device, timeout=None, record=None, log=None, publish=None):
+    """Returns the shared bus for a -d/--device argument.
+
+    "socketcan:<interface>" selects a SocketcanBus, "sim" an in-process
+    fdcanusb_simulator.SimulatorBus, "replay:<log>" a
+    bus_recording.ReplayBus, anything else is taken as the fdcanusb
+    serial device.  With record, all traffic is logged to that file,
+    with log, commanded and measured state to that telemetry log, and
+    with publish, the latest state to that shared memory block.
+    """
+    # The simulator and the recorder are built on this module.
+    if device.startswith('socketcan:'):
+        bus = SocketcanBus.shared(device[len('socketcan:'):], timeout=timeout)
+    elif device == 'sim':
+        import fdcanusb_simulator
+        bus = fdcanusb_simulator.SimulatorBus.shared(timeout=timeout)
+    elif device.startswith('replay:'):
+        import bus_recording
+        bus = bus_recording.ReplayBus.shared(device[len('replay:'):], timeout=timeout)
+    else:
+        bus = FdcanusbBus.shared(device, timeout=timeout)
+    if record is not None:
+        import bus_recording
+        bus = bus_recording.RecordingBus.shared(bus, record)
+    if log is not None and bus.telemetry_log is None:
+        import telemetry_log
+        bus.telemetry_log = telemetry_log.TelemetryLog(log)
+    if publish is not None and bus.publisher is None:
+        import live_telemetry
+        bus.publisher = live_telemetry.TelemetryPublisher(publish)
+    return bus
+
+
 class Controller:
-    def __init__(self, controller_ID):
-        parser = argparse.ArgumentParser(description=__doc__)
+    """Handle for one moteus controller on a bus.
+
+    With delta=True position commands leave out the position mode
+    registers whose value is the controller's default (zero velocity
+    and feedforward torque, kp and kd scales of 1).  The controller
+    resets every register a frame leaves out to its default, see
+    PositionResolution, so the frame means the same and nothing depends
+    on earlier frames having arrived.
+    """
 
-        parser.add_argument('-d', '--device', type=str, default='/dev/fdcanusb',
-                            help='serial device')
-        parser.add_argument('-t', '--target', type=int, default=controller_ID,
-                            help='ID of target device')
-        args = parser.parse_args()
+    # Position mode values in make_position order and the controller
+    # defaults they fall back to when left out, None for the ones that
+    # are always written.
+    POSITION_DEFAULTS = (None, 0., 0., 1., 1., None)
 
-        self.serial = serial.Serial(port=args.device)
-        self.target = args.target
+    def __init__(self, controller_ID, bus=None, query_resolution=None, position_resolution=None,
+                 query_plan=None, telemetry=False, delta=False):
+        if bus is None:
+            parser = argparse.ArgumentParser(description=__doc__)
+
+            parser.add_argument('-d', '--device', type=str, default='/dev/fdcanusb',
+                                help='fdcanusb serial device, socketcan:<interface>, sim or replay:<log>')
+            parser.add_argument('-t', '--target', type=int, default=controller_ID,
+                                help='ID of target device')
+            parser.add_argument('--record', type=str, default=None,
+                                help='log all bus traffic to this file')
+            parser.add_argument('--log', type=str, default=None,
+                                help='log commanded and measured state to this telemetry log')
+            parser.add_argument('--publish', type=str, default=None,
+                                help='publish the latest state to this shared memory block')
+            parser.add_argument('--timeout', type=float, default=None,
+                                help='seconds to wait for replies, forever if not given')
+            args = parser.parse_args()
+
+            bus = open_bus(args.device, timeout=args.timeout, record=args.record, log=args.log,
+                           publish=args.publish)
+            controller_ID = args.target
+
+        self.bus = bus
+        self.target = controller_ID
+        self.__stop_template = FrameTemplate(controller_ID, False, bytes([
+            0x01,  # write int8 1x
+            MoteusReg.MOTEUS_REG_MODE,
+            MoteusMode.STOPPED]))
+        if query_plan is None:
+            query_plan = DEFAULT_QUERY if query_resolution is None else query_resolution.plan()
+        self.query_plan = query_plan
+        self.telemetry = Telemetry() if telemetry else None
+        self.__position_resolution = position_resolution
+        self.__query_templates = {}
+        self.__position_templates = {False: self.__make_position_template(None)}
+        self.__delta = delta
+        self.__delta_templates = {}
 
         # Send a stop to begin with, in case we have a fault or
         # something.  The fault states are latching, and require a
         # stop command in order to make the device move again.
         self.command_stop()
 
-    def __hexify(self, data):
-        return ''.join(['{:02x}'.format(x) for x in data])
+    def __make_position_template(self, query_plan):
+        reply = query_plan is not None
+        suffix = query_plan.frame if reply else b''
+        if self.__position_resolution is None:
+            position_prefix = bytes([
+                0x01,  # write int8 1x
+                MoteusReg.MOTEUS_REG_MODE,
+                MoteusMode.POSITION,
+                0x0c,
+                6,  # write float32 6x
+                MoteusReg.MOTEUS_REG_POS_POSITION])
+            return FrameTemplate(self.target, reply, position_prefix, '<ffffff', suffix)
 
-    def __dehexify(self, data):
-        result = b''
-        for i in range(0, len(data), 2):
-            result += bytes([int(data[i:i + 2], 16)])
-        return result
+        mode_prefix = bytes([
+            0x01,  # write int8 1x
+            MoteusReg.MOTEUS_REG_MODE,
+            MoteusMode.POSITION])
+        return ScaledFrameTemplate(self.target, reply, mode_prefix, self.__position_resolution.fields(),
+                                   MoteusReg.MOTEUS_REG_POS_POSITION, suffix)
 
-    def __readline(self, stream):
-        result = bytearray()
-        while True:
-            char = stream.read(1)
-            if char == b'\n':
-                if len(result):
-                    return result
-            else:
-                result += char
+    def __make_delta_template(self, mask, query_plan):
+        resolution = self.__position_resolution
+        if resolution is None:
+            resolution = PositionResolution()
+        fields = [(register, field_type if mask & (1 << index) else MoteusReg.IGNORE)
+                  for index, (register, field_type) in enumerate(resolution.fields())]
+        mode_prefix = bytes([
+            0x01,  # write int8 1x
+            MoteusReg.MOTEUS_REG_MODE,
+            MoteusMode.POSITION])
+        return ScaledFrameTemplate(self.target, query_plan is not None, mode_prefix, fields,
+                                   MoteusReg.MOTEUS_REG_POS_POSITION,
+                                   query_plan.frame if query_plan is not None else b'')
+
+    def __delta_template(self, values, query_plan):
+        mask = 0
+        for index, default in enumerate(self.POSITION_DEFAULTS):
+            if default is None or values[index] != default:
+                mask |= 1 << index
+        key = (mask, query_plan)
+        template = self.__delta_templates.get(key)
+        if template is None:
+            template = self.__make_delta_template(mask, query_plan)
+            self.__delta_templates[key] = template
+        return template
+
+    def __default_plan(self):
+        scheduler = self.bus.scheduler
+        return self.query_plan if scheduler is None else scheduler.plan
 
     def __read_varuint(self, stream):
         result = 0
@@ -117,7 +1507,9 @@ class Controller:
         data = stream.read(s.size)
         return s.unpack(data)[0]
 
-    def __parse_register_reply(self, data):
+    def __parse_register_reply(self, data, scaled=False):
+        # With scaled=True integer registers are converted to physical
+        # units and register errors are left out.
         stream = io.BytesIO(data)
         result = {}
 
@@ -133,15 +1525,22 @@ class Controller:
                     size = self.__read_varuint(stream)
                 start_reg = self.__read_varuint(stream)
                 for i in range(size):
-                    result[start_reg + i] = self.__read_type(stream, field_type)
+                    value = self.__read_type(stream, field_type)
+                    if scaled:
+                        scale = scale_of(start_reg + i, field_type)
+                        if scale is not None:
+                            value = from_int(value, scale, field_type)
+                    result[start_reg + i] = value
             elif opcode_base == MoteusReg.WRITE_ERROR:
                 reg = self.__read_varuint(stream)
                 err = self.__read_varuint(stream)
-                result[reg] = 'werr {}'.format(err)
+                if not scaled:
+                    result[reg] = 'werr {}'.format(err)
             elif opcode_base == MoteusReg.READ_ERROR:
                 reg = self.__read_varuint(stream)
                 err = self.__read_varuint(stream)
-                result[reg] = 'rerr {}'.format(err)
+                if not scaled:
+                    result[reg] = 'rerr {}'.format(err)
             elif opcode_base == MoteusReg.NOP:
                 pass
             else:
@@ -150,116 +1549,145 @@ class Controller:
 
         return result
 
-    def __send_can_frame(self, frame, reply, discard_adapter_response=True, print_data=False):
-
-        if reply: reply_indicator = 0x80
-        else: reply_indicator = 0x00
-        self.serial.write("can send {:02x}{:02x} {}\n" .format(reply_indicator, self.target, self.__hexify(frame)).encode('latin1'))
-
-        if discard_adapter_response:
-            # Read (and discard) the adapters response.
-            ok_response = self.__readline(self.serial)
-            if not ok_response.startswith(b"OK"):
-                raise RuntimeError("fdcanusb responded with: " +
-                                   ok_response.decode('latin1'))
-
-            if reply:
-                # Read the devices response.
-                device = self.__readline(self.serial)
-
-                # if not device.startswith(b"rcv"):
-                #     raise RuntimeError("unexpected response")
-
-                fields = device.split(b" ")
-                response = self.__dehexify(fields[2])
-                response_data = self.__parse_register_reply(response)
-
-                if print_data:
-                    print("Mode: {: 2d}  Pos: {: 6.2f}deg  Vel: {: 6.2f}dps  "
-                          "Torque: {: 6.2f}Nm  Temp: {: 3d}C  Voltage: {: 3.1f}V    ".format(
-                            int(response_data[MoteusReg.MOTEUS_REG_MODE]),
-                            response_data[MoteusReg.MOTEUS_REG_POSITION] * 360.0,
-                            response_data[MoteusReg.MOTEUS_REG_VELOCITY] * 360.0,
-                            response_data[MoteusReg.MOTEUS_REG_TORQUE],
-                            response_data[MoteusReg.MOTEUS_REG_TEMP_C],
-                            response_data[MoteusReg.MOTEUS_REG_V] * 0.5))
-                return response_data
-
-    def command_stop(self):
-        buf = io.BytesIO()
-        buf.write(struct.pack(
-            "<bbb",
-            0x01,  # write int8 1x
-            MoteusReg.MOTEUS_REG_MODE,
-            MoteusMode.STOPPED))
-
-        self.__send_can_frame(buf.getvalue(), reply=False)
+    def parse_reply(self, device, print_data=False, layout=None):
+        """Parses a reply payload as hex, the way the fdcanusb prints it."""
+        return self.parse_frame(binascii.unhexlify(device), print_data=print_data, layout=layout)
 
+    def parse_frame(self, response, print_data=False, layout=None):
+        """Parses a binary reply payload."""
+        scaled = False
+        if layout is None:
+            layout = self.query_plan.layout
+        if not layout.matches(response):
+            for layout in REPLY_LAYOUTS:
+                if layout.matches(response):
+                    break
+            else:
+                layout = None
 
-    def set_position(self, position, velocity=0., max_torque=0.5, ff_torque=0., kp_scale=1., kd_scale=1.,
-                     get_data=False, print_data=False):
-        buf = io.BytesIO()
-        buf.write(struct.pack(
-            "<bbb",
-            0x01,  # write int8 1x
-            MoteusReg.MOTEUS_REG_MODE,
-            MoteusMode.POSITION))
-        buf.write(struct.pack(
-            "<bbbffffff",
-            0x0c,
-            6,  # write float32 6x
-            MoteusReg.MOTEUS_REG_POS_POSITION,
-            position,
-            velocity,
-            ff_torque,
-            kp_scale,
-            kd_scale,
-            max_torque,
-        ))
-        if get_data:
-            buf.write(struct.pack(
-                "<bbb",
-                0x1c,  # read float32 (variable number)
-                4,  # 4 registers
-                0x00  # starting at 0
-            ))
-            buf.write(struct.pack(
-                "<bb",
-                0x13,  # read int8 3x
-                MoteusReg.MOTEUS_REG_V))
-            return self.__send_can_frame(buf.getvalue(), reply=True, print_data=print_data)
+        if self.telemetry is not None:
+            response_data = self.telemetry
+            scaled = True
+            if layout is not None:
+                layout.decode_into(response, response_data)
+            else:
+                response_data.update(self.__parse_register_reply(response, scaled=True))
+        elif layout is not None:
+            response_data = layout.decode(response)
+            scaled = layout.scaled
         else:
-            self.__send_can_frame(buf.getvalue(), reply=False, print_data=print_data)
+            response_data = self.__parse_register_reply(response)
 
+        if print_data:
+            voltage = response_data.get(MoteusReg.MOTEUS_REG_V, math.nan)
+            print("Mode: {: 2.0f}  Pos: {: 6.2f}deg  Vel: {: 6.2f}dps  "
+                  "Torque: {: 6.2f}Nm  Temp: {: 3.0f}C  Voltage: {: 3.1f}V    ".format(
+                    response_data.get(MoteusReg.MOTEUS_REG_MODE, math.nan),
+                    response_data.get(MoteusReg.MOTEUS_REG_POSITION, math.nan) * 360.0,
+                    response_data.get(MoteusReg.MOTEUS_REG_VELOCITY, math.nan) * 360.0,
+                    response_data.get(MoteusReg.MOTEUS_REG_TORQUE, math.nan),
+                    response_data.get(MoteusReg.MOTEUS_REG_TEMP_C, math.nan),
+                    voltage if scaled else voltage * 0.5))
+        return response_data
 
-    def set_velocity(self, velocity=0., max_torque=0.5, ff_torque=0., kd_scale=1., get_data=False, print_data=False):
-        if get_data:
-            return self.set_position(position = math.nan, velocity=velocity, max_torque=max_torque, ff_torque=ff_torque,
-                          kp_scale=0, kd_scale=kd_scale, get_data=True, print_data=print_data)
-        else:
-            self.set_position(position=math.nan, velocity=velocity, max_torque=max_torque, ff_torque=ff_torque,
-                              kp_scale=0, kd_scale=kd_scale, get_data=False, print_data=False)
+    def __send_command(self, command, timeout=None):
+        result, = self.bus.cycle([command], timeout)
+        return result
 
-    def set_torque(self, torque=0., get_data=False, print_data=False):
-        if get_data:
-            return self.set_position(position = math.nan, velocity=0, max_torque=abs(torque), ff_torque=torque,
-                          kp_scale=0, kd_scale=0, get_data=True, print_data=print_data)
+    def make_stop(self):
+        frame, line = self.__stop_template.encode()
+        return Command(self, frame, line, reply=False)
+
+    def make_position(self, position, velocity=0., max_torque=0.5, ff_torque=0., kp_scale=1., kd_scale=1.,
+                      get_data=False, print_data=False, query_plan=None):
+        values = (position, velocity, ff_torque, kp_scale, kd_scale, max_torque)
+        if self.__delta:
+            if not get_data:
+                query_plan = None
+            elif query_plan is None:
+                query_plan = self.__default_plan()
+            template = self.__delta_template(values, query_plan)
+        elif get_data:
+            if query_plan is None:
+                query_plan = self.__default_plan()
+            template = self.__position_templates.get(query_plan)
+            if template is None:
+                template = self.__make_position_template(query_plan)
+                self.__position_templates[query_plan] = template
         else:
-            self.set_position(position=math.nan, velocity=0, max_torque=abs(torque), ff_torque=torque,
-                              kp_scale=0, kd_scale=0, get_data=False, print_data=False)
-
-    def get_data(self, print_data=False):
-        buf = io.BytesIO()
-        buf.write(struct.pack(
-            "<bbb",
-            0x1c,  # read float32 (variable number)
-            4,  # 4 registers
-            0x00  # starting at 0
-        ))
-        buf.write(struct.pack(
-            "<bb",
-            0x13,  # read int8 3x
-            MoteusReg.MOTEUS_REG_V))
-
-        return self.__send_can_frame(buf.getvalue(), reply=True, print_data=print_data)
+            query_plan = None
+            template = self.__position_templates[False]
+        frame, line = template.encode(*values)
+        return Command(self, frame, line, reply=get_data, print_data=print_data,
+                       layout=query_plan.layout if query_plan is not None else None, values=values)
+
+    def make_velocity(self, velocity=0., max_torque=0.5, ff_torque=0., kd_scale=1., get_data=False, print_data=False,
+                      query_plan=None):
+        return self.make_position(position=math.nan, velocity=velocity, max_torque=max_torque, ff_torque=ff_torque,
+                                  kp_scale=0, kd_scale=kd_scale, get_data=get_data, print_data=print_data,
+                                  query_plan=query_plan)
+
+    def make_torque(self, torque=0., get_data=False, print_data=False, query_plan=None):
+        return self.make_position(position=math.nan, velocity=0, max_torque=abs(torque), ff_torque=torque,
+                                  kp_scale=0, kd_scale=0, get_data=get_data, print_data=print_data,
+                                  query_plan=query_plan)
+
+    def make_query(self, print_data=False, query_plan=None):
+        if query_plan is None:
+            query_plan = self.__default_plan()
+        template = self.__query_templates.get(query_plan)
+        if template is None:
+            template = FrameTemplate(self.target, True, query_plan.frame)
+            self.__query_templates[query_plan] = template
+        frame, line = template.encode()
+        return Command(self, frame, line, reply=True, print_data=print_data, layout=query_plan.layout)
+
+    def command_stop(self, timeout=None):
+        self.__send_command(self.make_stop(), timeout)
+
+    def set_position(self, position, velocity=0., max_torque=0.5, ff_torque=0., kp_scale=1., kd_scale=1.,
+                     get_data=False, print_data=False, query_plan=None, timeout=None):
+        return self.__send_command(self.make_position(
+            position, velocity=velocity, max_torque=max_torque, ff_torque=ff_torque,
+            kp_scale=kp_scale, kd_scale=kd_scale, get_data=get_data, print_data=print_data,
+            query_plan=query_plan), timeout)
+
+    def set_velocity(self, velocity=0., max_torque=0.5, ff_torque=0., kd_scale=1., get_data=False, print_data=False,
+                     query_plan=None, timeout=None):
+        return self.__send_command(self.make_velocity(
+            velocity=velocity, max_torque=max_torque, ff_torque=ff_torque, kd_scale=kd_scale,
+            get_data=get_data, print_data=print_data, query_plan=query_plan), timeout)
+
+    def set_torque(self, torque=0., get_data=False, print_data=False, query_plan=None, timeout=None):
+        return self.__send_command(self.make_torque(torque=torque, get_data=get_data, print_data=print_data,
+                                                    query_plan=query_plan), timeout)
+
+    def get_data(self, print_data=False, query_plan=None, timeout=None):
+        return self.__send_command(self.make_query(print_data=print_data, query_plan=query_plan), timeout)
+
+    async def __async_send_command(self, command, timeout=None):
+        result, = await self.bus.async_cycle([command], timeout)
+        return result
+
+    async def async_command_stop(self, timeout=None):
+        await self.__async_send_command(self.make_stop(), timeout)
+
+    async def async_set_position(self, position, velocity=0., max_torque=0.5, ff_torque=0., kp_scale=1., kd_scale=1.,
+                                 get_data=False, print_data=False, query_plan=None, timeout=None):
+        return await self.__async_send_command(self.make_position(
+            position, velocity=velocity, max_torque=max_torque, ff_torque=ff_torque,
+            kp_scale=kp_scale, kd_scale=kd_scale, get_data=get_data, print_data=print_data,
+            query_plan=query_plan), timeout)
+
+    async def async_set_velocity(self, velocity=0., max_torque=0.5, ff_torque=0., kd_scale=1., get_data=False,
+                                 print_data=False, query_plan=None, timeout=None):
+        return await self.__async_send_command(self.make_velocity(
+            velocity=velocity, max_torque=max_torque, ff_torque=ff_torque, kd_scale=kd_scale,
+            get_data=get_data, print_data=print_data, query_plan=query_plan), timeout)
+
+    async def async_set_torque(self, torque=0., get_data=False, print_data=False, query_plan=None, timeout=None):
+        return await self.__async_send_command(self.make_torque(torque=torque, get_data=get_data,
+                                                                print_data=print_data, query_plan=query_plan), timeout)
 
+    async def async_get_data(self, print_data=False, query_plan=None, timeout=None):
+        return await self.__async_send_command(self.make_query(print_data=print_data, query_plan=query_plan), timeout)
@@ -0,0 +1,125 @@
+"""Fixed-rate loop timing on absolute deadlines.
+
+Replaces sleeping for whatever is left of the period after the work,
+which drifts by the sleep overshoot every tick, follows wall clock
+jumps and can't tell when a tick ran long:
+
+    loop = RateLoop(300)
+    while True:
+        ...
+        loop.wait()
+
+Ticks are scheduled on a grid of perf_counter_ns deadlines.  wait()
+sleeps until shortly before the next deadline and busy-waits the last
+spin seconds, since a plain sleep wakes up late by anything from tens
+of microseconds to a scheduler tick.  When the work overruns a
+deadline the overrun policy decides what happens next:
+
+  SKIP      drop the missed ticks and wait for the next deadline on
+            the original grid (default)
+  CATCH_UP  run the missed ticks back to back until back on the grid
+  STRETCH   start a new grid, one period after now
+"""
+import array
+import math
+import time
+
+from moteus_fdcan_adapter import percentile
+
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+STRETCH = 'stretch'
+
+
+class RateLoop:
+    """Paces a loop to freq ticks per second, see the module docstring.
+
+    The lateness of every wake-up is kept in a ring of the last history
+    ticks for stats().
+    """
+
+    def __init__(self, freq, spin=0.0002, overrun=SKIP, history=4096):
+        if overrun not in (SKIP, CATCH_UP, STRETCH):
+            raise ValueError('unknown overrun policy {!r}'.format(overrun))
+        self.freq = freq
+        self.period_ns = round(1e9 / freq)
+        self.spin_ns = round(spin * 1e9)
+        self.overrun = overrun
+        self.lateness = array.array('q', bytes(8 * history))
+        self.reset()
+
+    def reset(self):
+        """Starts a new grid, with the first deadline one period from now."""
+        self.start_ns = time.perf_counter_ns()
+        self.deadline_ns = self.start_ns + self.period_ns
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.worst_late_ns = 0
+        self.total_late_ns = 0
+
+    @property
+    def elapsed(self):
+        """Seconds since the grid started."""
+        return (time.perf_counter_ns() - self.start_ns) * 1e-9
+
+    def remaining(self):
+        """Seconds left until the next deadline, negative once it passed."""
+        return (self.deadline_ns - time.perf_counter_ns()) * 1e-9
+
+    def wait(self):
+        """Waits for the next deadline, returns how late the wake-up was in seconds."""
+        deadline = self.deadline_ns
+        now = time.perf_counter_ns()
+        if now > deadline:
+            self.overruns += 1
+            if self.overrun == SKIP:
+                missed = (now - deadline) // self.period_ns + 1
+                self.skipped += missed
+                deadline += missed * self.period_ns
+            elif self.overrun == STRETCH:
+                deadline = now + self.period_ns
+            else:
+                # CATCH_UP: this tick is already due.
+                self.deadline_ns = deadline + self.period_ns
+                self.__record(now - deadline)
+                return (now - deadline) * 1e-9
+        remaining = deadline - now - self.spin_ns
+        if remaining > 0:
+            time.sleep(remaining * 1e-9)
+        while time.perf_counter_ns() < deadline:
+            pass
+        late = time.perf_counter_ns() - deadline
+        self.deadline_ns = deadline + self.period_ns
+        self.__record(late)
+        return late * 1e-9
+
+    def __record(self, late):
+        self.lateness[self.ticks % len(self.lateness)] = late
+        self.ticks += 1
+        self.total_late_ns += late
+        if late > self.worst_late_ns:
+            self.worst_late_ns = late
+
+    def stats(self, points=(50, 90, 99, 100)):
+        """Tick counts, achieved rate and wake-up lateness percentiles in seconds."""
+        count = min(self.ticks, len(self.lateness))
+        ordered = sorted(self.lateness[:count])
+        elapsed = self.elapsed
+        result = {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'rate': self.ticks / elapsed if elapsed > 0 else math.nan,
+            'worst_late': self.worst_late_ns * 1e-9,
+        }
+        for point in points:
+            result['p{}'.format(point)] = percentile(ordered, point) * 1e-9
+        return result
+
+    def summary(self):
+        stats = self.stats()
+        return ('{ticks} ticks at {rate:.1f}/s of {freq:g}/s, {overruns} overruns ({skipped} ticks skipped), '
+                'late p50 {p50_us:.0f}us p99 {p99_us:.0f}us max {max_us:.0f}us').format(
+                    freq=self.freq, p50_us=stats['p50'] * 1e6, p99_us=stats['p99'] * 1e6,
+                    max_us=stats['worst_late'] * 1e6, **stats)
@@ -0,0 +1,312 @@
+"""Runs a control loop in its own real-time process.
+
+The supervisor (the script that starts the runner, free to print, plot
+or use pyautogui) and the control process share nothing but memory:
+
+  setpoints  written by the supervisor with set(), read by the control
+             process at the start of every tick
+  telemetry  the latest state of every controller, published by the
+             control process's bus, see live_telemetry
+  status     tick count, overruns and lateness, written by the control
+             process
+
+The control process pins itself to a CPU (ideally one kept free with
+isolcpus), optionally asks for SCHED_FIFO, locks its memory and keeps
+the garbage collector out of the ticks.  Whatever it isn't allowed to
+do (SCHED_FIFO and mlockall usually need root or CAP_SYS_NICE and
+CAP_IPC_LOCK) is reported and skipped.
+
+make_step is called once in the control process with the bus and
+returns step(setpoints), which is called every tick.  Both have to be
+importable from a module, the control process is spawned fresh:
+
+    runner = ControlProcess(make_step, ('x', 'z'), freq=300, device='/dev/fdcanusb', cpu=3, priority=80)
+    runner.start()
+    runner.set(x=0, z=-180)
+    ...
+    runner.stop()
+
+Running this file runs a demo on the simulator and prints the timing:
+
+    python realtime_runner.py -d sim --cpu 3 --priority 80
+"""
+import argparse
+import ctypes
+import gc
+import math
+import multiprocessing
+import os
+import resource
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+
+from live_telemetry import TelemetryReader
+from live_telemetry import read_seqlock
+from moteus_fdcan_adapter import open_bus
+from rate_loop import STRETCH
+from rate_loop import RateLoop
+
+MAGIC = b'MFDRTPR1'
+# Magic and the setpoint sequence counter, then the setpoints as doubles.
+HEADER = struct.Struct('<8sQ')
+SEQUENCE_OFFSET = 8
+# Stop request byte written by the supervisor, then the status sequence
+# counter and the ticks run, overruns, and the worst and total lateness
+# of the tick starts in ns written by the control process, see
+# rate_loop.RateLoop.
+STATUS_SEQUENCE_OFFSET = 8
+STATUS_OFFSET = 16
+STATUS = struct.Struct('<QQqq')
+
+_SEQUENCE = struct.Struct('<Q')
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# With gc='idle', the collector runs when at least this much of a tick is left.
+GC_SLACK_S = 0.002
+
+# Seqlock reads give up once they are done spinning.  The control
+# process then keeps the previous setpoints rather than wait, at
+# SCHED_FIFO, on a supervisor preempted in the middle of a write.
+READ_TIMEOUT_S = 0
+
+
+class ControlBlock:
+    """Shared memory layout of one runner: setpoints and status."""
+
+    def __init__(self, name, fields, create=False):
+        self.fields = tuple(fields)
+        self.setpoints = struct.Struct('<{}d'.format(len(self.fields)))
+        self.stop_offset = HEADER.size + self.setpoints.size
+        size = self.stop_offset + STATUS_OFFSET + STATUS.size
+        if create:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+            self.memory.buf[:size] = bytes(size)
+            HEADER.pack_into(self.memory.buf, 0, MAGIC, 0)
+            self.setpoints.pack_into(self.memory.buf, HEADER.size, *([math.nan] * len(self.fields)))
+        else:
+            # The control process shares the supervisor's resource
+            # tracker, which unlinks the block if the supervisor dies.
+            self.memory = shared_memory.SharedMemory(name)
+        self.buffer = self.memory.buf
+        self.sequence = 0
+        self.status_sequence = 0
+        self.previous = (math.nan,) * len(self.fields)
+        self.status = (0, 0, 0, 0)
+
+    def write_setpoints(self, values):
+        buffer = self.buffer
+        self.sequence += 1
+        _SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+        self.setpoints.pack_into(buffer, HEADER.size, *values)
+        self.sequence += 1
+        _SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+
+    def read_setpoints(self):
+        """The current setpoints, or the previous ones if they are being written."""
+        values = read_seqlock(self.buffer, SEQUENCE_OFFSET, self.setpoints, HEADER.size, READ_TIMEOUT_S)
+        if values is not None:
+            self.previous = values
+        return self.previous
+
+    def read_status(self):
+        status = read_seqlock(self.buffer, self.stop_offset + STATUS_SEQUENCE_OFFSET,
+                              STATUS, self.stop_offset + STATUS_OFFSET, READ_TIMEOUT_S)
+        if status is not None:
+            self.status = status
+        return self.status
+
+    def write_status(self, ticks, overruns, worst_late, total_late):
+        buffer = self.buffer
+        offset = self.stop_offset + STATUS_SEQUENCE_OFFSET
+        self.status_sequence += 1
+        _SEQUENCE.pack_into(buffer, offset, self.status_sequence)
+        STATUS.pack_into(buffer, self.stop_offset + STATUS_OFFSET, ticks, overruns, worst_late, total_late)
+        self.status_sequence += 1
+        _SEQUENCE.pack_into(buffer, offset, self.status_sequence)
+
+    def request_stop(self):
+        self.buffer[self.stop_offset] = 1
+
+    def stop_requested(self):
+        return self.buffer[self.stop_offset] != 0
+
+    def close(self, unlink=False):
+        self.buffer = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def _report(message):
+    print('realtime_runner: ' + message, file=sys.stderr)
+
+
+def make_realtime(cpu=None, priority=None, lock_memory=True):
+    """Applies the real-time settings to the calling process.
+
+    Returns the list of settings that could not be applied.
+    """
+    failed = []
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except OSError as e:
+            failed.append('CPU {} affinity: {}'.format(cpu, e.strerror))
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except OSError as e:
+            failed.append('SCHED_FIFO priority {}: {}'.format(priority, e.strerror))
+    if lock_memory:
+        flags = MCL_CURRENT
+        # Locking future mappings past RLIMIT_MEMLOCK would make later
+        # allocations fail, so only do that without a limit.
+        if resource.getrlimit(resource.RLIMIT_MEMLOCK)[0] == resource.RLIM_INFINITY:
+            flags |= MCL_FUTURE
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.mlockall(flags) != 0:
+            failed.append('mlockall: {}'.format(os.strerror(ctypes.get_errno())))
+    return failed
+
+
+def _control_main(make_step, name, fields, freq, device, publish, cpu, priority, lock_memory, gc_mode):
+    block = ControlBlock(name, fields)
+    bus = open_bus(device, publish=publish)
+    step = make_step(bus)
+
+    for failure in make_realtime(cpu, priority, lock_memory):
+        _report('could not set ' + failure)
+    if gc_mode != 'on':
+        # Everything allocated so far lives for the whole run.
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+
+    # After an overrun start again from now rather than rushing to catch up.
+    loop = RateLoop(freq, overrun=STRETCH)
+    try:
+        while not block.stop_requested():
+            step(dict(zip(fields, block.read_setpoints())))
+            if gc_mode == 'idle' and loop.remaining() > GC_SLACK_S:
+                gc.collect(0)
+            loop.wait()
+            block.write_status(loop.ticks, loop.overruns, loop.worst_late_ns, loop.total_late_ns)
+    finally:
+        gc.enable()
+        if bus.publisher is not None:
+            bus.publisher.close()
+        bus.close()
+        block.close()
+
+
+class ControlProcess:
+    """Supervisor side of a control loop running in its own process.
+
+    fields names the setpoints passed to step.  gc is 'off' to disable
+    the garbage collector for the run, 'idle' to also collect the
+    youngest generation in the spare time of ticks, or 'on'.
+    """
+
+    def __init__(self, make_step, fields=(), freq=300, device='/dev/fdcanusb', cpu=None, priority=None,
+                 lock_memory=True, gc='idle', name=None, publish='moteus_telemetry'):
+        self.make_step = make_step
+        self.fields = tuple(fields)
+        self.freq = freq
+        self.device = device
+        self.cpu = cpu
+        self.priority = priority
+        self.lock_memory = lock_memory
+        self.gc = gc
+        self.name = name if name is not None else 'moteus_rt_{}'.format(os.getpid())
+        self.publish = publish
+        self.block = None
+        self.process = None
+        self.__reader = None
+
+    def start(self):
+        self.block = ControlBlock(self.name, self.fields, create=True)
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(
+            target=_control_main, name='control',
+            args=(self.make_step, self.name, self.fields, self.freq, self.device, self.publish,
+                  self.cpu, self.priority, self.lock_memory, self.gc))
+        self.process.start()
+
+    def set(self, **setpoints):
+        """Updates some of the setpoints, the others keep their values."""
+        current = dict(zip(self.fields, self.block.read_setpoints()))
+        current.update(setpoints)
+        self.block.write_setpoints([current[field] for field in self.fields])
+
+    def status(self):
+        """Returns ticks, overruns, and the worst and mean tick start lateness in seconds."""
+        ticks, overruns, worst_late, total_late = self.block.read_status()
+        return {'ticks': ticks, 'overruns': overruns, 'worst_late': worst_late * 1e-9,
+                'mean_late': total_late * 1e-9 / max(1, ticks)}
+
+    def telemetry(self):
+        """Latest state of every controller, see live_telemetry.TelemetryReader.snapshot."""
+        if self.__reader is None:
+            self.__reader = TelemetryReader(self.publish, untrack=False)
+        return self.__reader.snapshot()
+
+    def stop(self, timeout=1.):
+        if self.process is None:
+            return
+        self.block.request_stop()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+        if self.__reader is not None:
+            self.__reader.close()
+            self.__reader = None
+        self.block.close(unlink=True)
+        self.block = None
+
+
+def _demo_step(bus):
+    controllers = [bus.controller(controller_ID) for controller_ID in (1, 2, 3)]
+
+    def step(setpoints):
+        position = setpoints['amplitude'] * math.sin(time.monotonic() * 2 * math.pi)
+        if position != position:
+            position = 0.
+        bus.cycle([controller.make_position(position, get_data=True) for controller in controllers])
+
+    return step
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--device', type=str, default='sim', help='bus, as for open_bus')
+    parser.add_argument('--freq', type=float, default=300., help='ticks per second')
+    parser.add_argument('--cpu', type=int, default=None, help='CPU to pin the control process to')
+    parser.add_argument('--priority', type=int, default=None, help='SCHED_FIFO priority')
+    parser.add_argument('--gc', type=str, default='idle', choices=('off', 'idle', 'on'))
+    parser.add_argument('--duration', type=float, default=5., help='seconds to run')
+    args = parser.parse_args()
+
+    runner = ControlProcess(_demo_step, ('amplitude',), freq=args.freq, device=args.device, cpu=args.cpu,
+                            priority=args.priority, gc=args.gc)
+    runner.start()
+    try:
+        end = time.monotonic() + args.duration
+        while time.monotonic() < end:
+            runner.set(amplitude=0.1)
+            time.sleep(0.5)
+            status = runner.status()
+            print('ticks {ticks:7d}  overruns {overruns:4d}  worst late {:7.3f}ms  mean late {:6.3f}ms'.format(
+                status['worst_late'] * 1e3, status['mean_late'] * 1e3, **status))
+        print(runner.telemetry().get(1))
+    finally:
+        runner.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Commanded and measured controller state, logged to a ring file.
+
+Attach a TelemetryLog to a bus and every cycle appends one fixed-size
+binary record per command: the bus tick, the controller, the commanded
+position mode values and the measured values from its reply (NaN for
+whatever wasn't commanded or read).  Records go into a memory-mapped
+ring file, so logging is a struct pack into memory and never waits on
+a disk or a terminal; the kernel writes the pages back on its own.
+
+    python example_Trot.py --log trot.tlm
+    python telemetry_log.py trot.tlm --csv trot.csv
+    python telemetry_log.py trot.tlm --npy trot.npy
+
+The file can be read while it is being written, records overwritten or
+being overwritten during the read are dropped.
+"""
+import argparse
+import math
+import mmap
+import struct
+import time
+
+import numpy as np
+
+from moteus_fdcan_adapter import Telemetry
+
+MAGIC = b'MFDTLM1\0'
+# Magic, record size, capacity and the number of records ever written.
+HEADER = struct.Struct('<8sIIQ')
+COUNT_OFFSET = 16
+
+COMMANDED_FIELDS = ('position', 'velocity', 'ff_torque', 'kp_scale', 'kd_scale', 'max_torque')
+MEASURED_REGISTERS = tuple(Telemetry.FIELDS)
+MEASURED_FIELDS = tuple(Telemetry.FIELDS[register] for register in MEASURED_REGISTERS)
+FIELDS = (('time', 'tick', 'controller') + tuple('cmd_' + name for name in COMMANDED_FIELDS) +
+          tuple('meas_' + name for name in MEASURED_FIELDS))
+
+# time, tick, controller ID, then the commanded and measured values.
+RECORD = struct.Struct('<dIB3x{}f'.format(len(COMMANDED_FIELDS) + len(MEASURED_FIELDS)))
+DTYPE = np.dtype([('time', '<f8'), ('tick', '<u4'), ('controller', 'u1'), ('', 'V3')] +
+                 [(name, '<f4') for name in FIELDS[3:]])
+
+NO_COMMAND = (math.nan,) * len(COMMANDED_FIELDS)
+NO_MEASUREMENT = (math.nan,) * len(MEASURED_FIELDS)
+
+# Conversions to physical units for each raw reply layout.
+_unit_scales = {}
+
+
+def _scales_for(layout):
+    scales = _unit_scales.get(layout)
+    if scales is None:
+        raw = dict(zip(layout.registers, [field[1] for field in layout.record_fields]))
+        scales = [raw.get(register) for register in MEASURED_REGISTERS]
+        _unit_scales[layout] = scales
+    return scales
+
+
+def measured(command, result):
+    """The MEASURED_FIELDS of a parsed reply, in physical units."""
+    values = [result.get(register, math.nan) for register in MEASURED_REGISTERS]
+    layout = command.layout
+    if command.controller.telemetry is None and layout is not None and not layout.scaled:
+        values = [value if scale is None else (math.nan if value == scale[1] else value * scale[0])
+                  for value, scale in zip(values, _scales_for(layout))]
+    return values
+
+
+class TelemetryLog:
+    """Writer side, installed as bus.telemetry_log.
+
+    capacity is the number of records kept, the oldest are overwritten
+    once the ring is full.
+    """
+
+    def __init__(self, path, capacity=65536):
+        self.path = path
+        self.capacity = capacity
+        self.file = open(path, 'w+b')
+        self.file.truncate(HEADER.size + capacity * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), HEADER.size + capacity * RECORD.size)
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, capacity, 0)
+        self.count = 0
+        self.tick = 0
+
+    def write(self, stamp, controller_ID, commanded, measured):
+        offset = HEADER.size + (self.count % self.capacity) * RECORD.size
+        RECORD.pack_into(self.map, offset, stamp, self.tick, controller_ID, *commanded, *measured)
+        self.count += 1
+        # Published after the record, so readers never see it half written.
+        struct.pack_into('<Q', self.map, COUNT_OFFSET, self.count)
+
+    def record(self, commands, results):
+        """Logs one bus cycle."""
+        now = time.monotonic()
+        for command, result in zip(commands, results):
+            self.write(now, command.target,
+                       NO_COMMAND if command.values is None else command.values,
+                       NO_MEASUREMENT if result is None else measured(command, result))
+        self.tick += 1
+
+    def close(self):
+        if self.map is None:
+            return
+        self.map.close()
+        self.map = None
+        self.file.close()
+
+
+def read(path):
+    """Returns the records in a log file, oldest first, as a NumPy structured array."""
+    with open(path, 'rb') as f:
+        data = f.read(HEADER.size)
+        magic, record_size, capacity, count = HEADER.unpack(data)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise RuntimeError('{} is not a telemetry log'.format(path))
+        ring = np.frombuffer(f.read(capacity * record_size), dtype=DTYPE)
+        f.seek(COUNT_OFFSET)
+        count_after, = struct.unpack('<Q', f.read(8))
+    # Records written during the read may have overwritten the oldest
+    # ones, and the writer may be filling the slot of the oldest left.
+    first = max(0, count_after - capacity + 1)
+    return ring[np.arange(first, count) % capacity]
+
+
+def write_csv(records, path):
+    with open(path, 'w') as f:
+        f.write(','.join(FIELDS) + '\n')
+        for record in records:
+            f.write(','.join(repr(record[name].item()) for name in FIELDS) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', type=str, help='telemetry log to read')
+    parser.add_argument('--csv', type=str, default=None, help='export as CSV')
+    parser.add_argument('--npy', type=str, default=None, help='export as a NumPy structured array')
+    args = parser.parse_args()
+
+    records = read(args.log)
+    if args.csv is not None:
+        write_csv(records, args.csv)
+    if args.npy is not None:
+        np.save(args.npy, records)
+    if records.size:
+        print('{} records, ticks {}..{}, {:.3f}s'.format(
+            records.size, records['tick'][0], records['tick'][-1], records['time'][-1] - records['time'][0]))
+    else:
+        print('no records')
+
+
+if __name__ == '__main__':
+    main()
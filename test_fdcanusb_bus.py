@@ -0,0 +1,259 @@
+import math
+import time
+import unittest
+
+from fdcanusb_simulator import FdcanusbSimulator
+from fdcanusb_simulator import SimulatedMoteus
+from fdcanusb_simulator import SimulatorBus
+from moteus_fdcan_adapter import DEFAULT_QUERY
+from moteus_fdcan_adapter import FdcanusbBus
+from moteus_fdcan_adapter import MoteusReg
+from moteus_fdcan_adapter import PositionResolution
+from moteus_fdcan_adapter import QueryPlan
+from moteus_fdcan_adapter import QueryResolution
+from moteus_fdcan_adapter import ReplyTimeout
+from moteus_fdcan_adapter import TelemetryGroup
+from moteus_fdcan_adapter import from_int
+from moteus_fdcan_adapter import scale_of
+from moteus_fdcan_adapter import to_int
+
+
+class MissingControllerTest(unittest.TestCase):
+    """A controller that drops off the bus answers again once it is back."""
+
+    def run_cycles(self, reader):
+        simulator = FdcanusbSimulator([1, 9])
+        bus = FdcanusbBus(simulator.start(), timeout=0.01)
+        self.addCleanup(simulator.stop)
+        self.addCleanup(bus.close)
+        if reader:
+            bus.start_reader()
+        controllers = [bus.controller(controller_ID) for controller_ID in (1, 9)]
+        removed = simulator.controllers.pop(9)
+        timeouts = 0
+        for tick in range(40):
+            if tick == 5:
+                simulator.controllers[9] = removed
+            try:
+                results = bus.cycle([controller.make_query() for controller in controllers])
+            except ReplyTimeout as e:
+                self.assertEqual(e.missing, [9])
+                timeouts += 1
+            else:
+                self.assertTrue(all(result is not None for result in results))
+            time.sleep(1 / 300)
+        self.assertEqual(timeouts, 5)
+        self.assertEqual(bus.misses[9], 5)
+        return bus
+
+    def test_recovers(self):
+        self.run_cycles(reader=False)
+
+    def test_recovers_with_reader(self):
+        bus = self.run_cycles(reader=True)
+        self.assertEqual(sum(len(pending) for pending in bus._pending.values()), 0)
+
+
+class ReaderTest(unittest.TestCase):
+
+    def make_bus(self, **kwargs):
+        self.simulator = FdcanusbSimulator([1], **kwargs)
+        bus = FdcanusbBus(self.simulator.start())
+        self.addCleanup(self.simulator.stop)
+        self.addCleanup(bus.close)
+        bus.start_reader()
+        return bus
+
+    def test_slow_reply_without_timeout(self):
+        bus = self.make_bus(reply_latency=0.15)
+        result, = bus.cycle([bus.controller(1).make_query()])
+        self.assertIsNotNone(result)
+
+    def test_adapter_error_fails_waiting_request(self):
+        bus = self.make_bus()
+        command = bus.controller(5).make_query()
+        receipt = bus.send_batch([command])
+        bus.serial.write(b'bogus\n')
+        with self.assertRaisesRegex(RuntimeError, 'fdcanusb responded with'):
+            bus.receive_batch([command], receipt)
+        result, = bus.cycle([bus.controller(1).make_query()])
+        self.assertIsNotNone(result)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_no_group_due(self):
+        bus = SimulatorBus()
+        scheduler = bus.schedule([TelemetryGroup([(MoteusReg.MOTEUS_REG_V, MoteusReg.INT8)], every=10, offset=1)])
+        controller = bus.controller(1)
+        for _ in range(20):
+            result, = bus.cycle([controller.make_query()])
+            self.assertIsNotNone(result)
+        self.assertEqual(scheduler.latest(1, MoteusReg.MOTEUS_REG_V)[0], 24.)
+
+    def test_empty_plan_rejected(self):
+        with self.assertRaises(ValueError):
+            QueryPlan([])
+
+    def test_register_outside_telemetry(self):
+        bus = SimulatorBus()
+        scheduler = bus.schedule([TelemetryGroup([(MoteusReg.MOTEUS_REG_POS_KP, MoteusReg.F32)], every=2)])
+        telemetry = bus.controller(1, telemetry=True)
+        plain = bus.controller(2)
+        tick = scheduler.tick
+        for _ in range(4):
+            bus.cycle([telemetry.make_position(0.1, kp_scale=0.5, get_data=True),
+                       plain.make_position(0.1, kp_scale=0.5, get_data=True)])
+        self.assertEqual(scheduler.tick, tick + 4)
+        self.assertEqual(scheduler.latest(2, MoteusReg.MOTEUS_REG_POS_KP)[0], 0.5)
+
+
+def written_registers(frame):
+    """Registers a frame writes, in order."""
+    registers = []
+    simulated = SimulatedMoteus(1)
+    simulated.write = lambda register, value: registers.append(register)
+    simulated.handle_frame(frame)
+    return registers
+
+
+class DeltaTest(unittest.TestCase):
+    """Delta frames leave the controller in the same state as full ones."""
+
+    COMMANDS = [
+        dict(position=0.1, velocity=0.5, ff_torque=0.2, kp_scale=0.5, kd_scale=0.25, max_torque=1.),
+        dict(position=0.2),
+        dict(position=0.3, kp_scale=0.5),
+        dict(position=math.nan, velocity=1., kp_scale=0., max_torque=2.),
+        dict(position=0.4, ff_torque=-0.5),
+    ]
+
+    def test_same_state_as_full_frames(self):
+        bus = SimulatorBus()
+        full = bus.controller(1)
+        delta = bus.controller(2, delta=True)
+        for kwargs in self.COMMANDS:
+            bus.cycle([full.make_position(**kwargs), delta.make_position(**kwargs)])
+            expected = bus.controllers[1].command
+            actual = bus.controllers[2].command
+            for register, value in expected.items():
+                if math.isnan(value):
+                    self.assertTrue(math.isnan(actual[register]))
+                else:
+                    self.assertAlmostEqual(actual[register], value, places=6)
+
+    def test_mask(self):
+        controller = SimulatorBus().controller(1, delta=True)
+        self.assertEqual(written_registers(controller.make_position(0.1).frame), [
+            MoteusReg.MOTEUS_REG_MODE, MoteusReg.MOTEUS_REG_POS_POSITION, MoteusReg.MOTEUS_REG_MAX_TORQUE])
+        self.assertEqual(written_registers(controller.make_position(0.1, velocity=1., kd_scale=0.5).frame), [
+            MoteusReg.MOTEUS_REG_MODE, MoteusReg.MOTEUS_REG_POS_POSITION, MoteusReg.MOTEUS_REG_POS_VELOCITY,
+            MoteusReg.MOTEUS_REG_POS_KD, MoteusReg.MOTEUS_REG_MAX_TORQUE])
+
+    def test_mask_with_resolution(self):
+        resolution = PositionResolution(position=MoteusReg.INT16, velocity=MoteusReg.INT16,
+                                        kp_scale=MoteusReg.INT8, max_torque=MoteusReg.INT16)
+        bus = SimulatorBus()
+        controller = bus.controller(1, delta=True, position_resolution=resolution)
+        command = controller.make_position(0.25, kp_scale=0.5, max_torque=1.)
+        self.assertEqual(written_registers(command.frame), [
+            MoteusReg.MOTEUS_REG_MODE, MoteusReg.MOTEUS_REG_POS_POSITION, MoteusReg.MOTEUS_REG_POS_KP,
+            MoteusReg.MOTEUS_REG_MAX_TORQUE])
+        bus.cycle([command])
+        simulated = bus.controllers[1].command
+        self.assertAlmostEqual(simulated[MoteusReg.MOTEUS_REG_POS_POSITION], 0.25)
+        self.assertAlmostEqual(simulated[MoteusReg.MOTEUS_REG_POS_KP], 0.5, places=2)
+        self.assertEqual(simulated[MoteusReg.MOTEUS_REG_POS_VELOCITY], 0.)
+
+
+class RoundTripTest(unittest.TestCase):
+    """Values survive encoding, the simulated controller and decoding."""
+
+    FIELD_TYPES = (MoteusReg.INT8, MoteusReg.INT16, MoteusReg.F32)
+    STATE = {
+        MoteusReg.MOTEUS_REG_POSITION: 0.25,
+        MoteusReg.MOTEUS_REG_VELOCITY: -1.5,
+        MoteusReg.MOTEUS_REG_TORQUE: 0.5,
+    }
+    COMMAND = (0.25, -1.5, 0.5, 0.5, 0.25, 1.)
+
+    def assertClose(self, actual, expected, register, field_type):
+        scale = scale_of(register, field_type)
+        if math.isnan(expected):
+            self.assertTrue(math.isnan(actual), (register, actual))
+        else:
+            self.assertAlmostEqual(actual, expected, delta=1e-6 if scale is None else scale / 2 + 1e-9)
+
+    def make_bus(self):
+        bus = SimulatorBus([1, 2])
+        for simulated in bus.controllers.values():
+            # Hold the state still between frames.
+            simulated.step = lambda now=None: None
+        return bus
+
+    def test_int_sentinels(self):
+        for field_type in self.FIELD_TYPES[:2]:
+            with self.subTest(field_type=field_type):
+                scale = scale_of(MoteusReg.MOTEUS_REG_POSITION, field_type)
+                nan = to_int(math.nan, scale, field_type)
+                self.assertTrue(math.isnan(from_int(nan, scale, field_type)))
+                # Saturation never produces the NaN sentinel.
+                self.assertEqual(to_int(-1e9, scale, field_type), nan + 1)
+                self.assertEqual(to_int(1e9, scale, field_type), -nan - 1)
+                self.assertEqual(from_int(to_int(0.25, scale, field_type), scale, field_type), 0.25)
+
+    def test_query(self):
+        for field_type in self.FIELD_TYPES:
+            with self.subTest(field_type=field_type):
+                plan = QueryResolution(position=field_type, velocity=field_type, torque=field_type,
+                                       voltage=field_type, temperature=field_type).plan()
+                bus = self.make_bus()
+                plain = bus.controller(1, query_plan=plan)
+                telemetry = bus.controller(2, query_plan=plan, telemetry=True)
+                expected = dict(self.STATE)
+                expected[MoteusReg.MOTEUS_REG_V] = 24.
+                expected[MoteusReg.MOTEUS_REG_TEMP_C] = 30.
+                for simulated in bus.controllers.values():
+                    simulated.position, simulated.velocity, simulated.torque = self.STATE.values()
+                reply = bus.controllers[1].handle_frame(plan.frame)
+                self.assertTrue(plan.layout.matches(reply))
+                self.assertFalse(DEFAULT_QUERY.layout.matches(reply))
+                for result in (plan.decode(reply), plain.get_data(), telemetry.get_data()):
+                    for register, value in expected.items():
+                        self.assertClose(result[register], value, register, field_type)
+                    self.assertEqual(result[MoteusReg.MOTEUS_REG_MODE], 0)
+
+                bus.controllers[2].position = math.nan
+                result = telemetry.get_data()
+                self.assertTrue(math.isnan(result[MoteusReg.MOTEUS_REG_POSITION]))
+                self.assertClose(result[MoteusReg.MOTEUS_REG_VELOCITY], -1.5,
+                                 MoteusReg.MOTEUS_REG_VELOCITY, field_type)
+
+    def test_position(self):
+        resolutions = [(None, MoteusReg.F32)] + [
+            (PositionResolution(*[field_type] * 6), field_type) for field_type in self.FIELD_TYPES]
+        for resolution, field_type in resolutions:
+            with self.subTest(field_type=field_type, scaled=resolution is not None):
+                bus = self.make_bus()
+                controller = bus.controller(1, position_resolution=resolution)
+                for position in (self.COMMAND[0], math.nan):
+                    values = (position,) + self.COMMAND[1:]
+                    controller.set_position(*values[:2], max_torque=values[5], ff_torque=values[2],
+                                            kp_scale=values[3], kd_scale=values[4])
+                    command = bus.controllers[1].command
+                    for register, value in zip(sorted(command), values):
+                        self.assertClose(command[register], value, register, field_type)
+
+    def test_fallback_in_physical_units(self):
+        bus = self.make_bus()
+        controller = bus.controller(1, telemetry=True)
+        plan = QueryPlan([(MoteusReg.MOTEUS_REG_V, MoteusReg.INT8), (MoteusReg.MOTEUS_REG_TEMP_C, MoteusReg.INT16)])
+        reply = bus.controllers[1].handle_frame(plan.frame)
+        self.assertFalse(controller.query_plan.layout.matches(reply))
+        result = controller.parse_frame(reply)
+        self.assertEqual(result[MoteusReg.MOTEUS_REG_V], 24.)
+        self.assertEqual(result[MoteusReg.MOTEUS_REG_TEMP_C], 30.)
+
+
+if __name__ == '__main__':
+    unittest.main()